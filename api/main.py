@@ -7,13 +7,38 @@ This is a humorous project that demonstrates API compatibility while
 providing duck-themed responses instead of actual AI content.
 """
 
+import atexit
 import base64
+import bisect
+import contextlib
+import copy
+import functools
 import json
+import logging
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import math
+import mmap
+import os
+import re
+import signal
+import socket
 import time
 import hashlib
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
 from typing import List, Dict, Any, Optional
+import numpy as np
 from fastapi import FastAPI, HTTPException, Request, Header, Depends
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import File, Form, UploadFile
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import secrets
 import random
@@ -35,6 +60,583 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per line: timestamp, level, event name and the record's structured fields"""
+
+    def __init__(self, redact_fields=()):
+        super().__init__()
+        self.redact_fields = {name.lower() for name in redact_fields}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname.lower(),
+            "event": record.getMessage(),
+        }
+        entry.update(redact_fields(getattr(record, "fields", {}), self.redact_fields))
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Plain text lines: time, level, event name and the record's structured fields"""
+
+    def __init__(self, redact_fields=()):
+        super().__init__("%(asctime)s %(levelname)s %(message)s %(fields)s")
+        self.redact_fields = {name.lower() for name in redact_fields}
+
+    def format(self, record: logging.LogRecord) -> str:
+        # Format a copy, so the queued record keeps its original fields
+        fields = redact_fields(getattr(record, "fields", {}), self.redact_fields)
+        return super().format(logging.makeLogRecord({**record.__dict__, "fields": fields}))
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queue handler that never blocks the caller: records are dropped (and counted)
+    when the queue is full, and exceptions are rendered to text before queueing.
+    """
+
+    def __init__(self, log_queue: "queue.Queue"):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogPipeline:
+    """
+    Request logging through an in-memory queue drained by a background writer thread,
+    so the event loop never waits on stdout. Request logs can be sampled 1 in N.
+    """
+
+    def __init__(self, sample_rate: int = 1, queue_size: int = 10000, log_format: str = "json",
+                 redact_fields=("authorization", "api_key"), name: str = "qlm"):
+        self.sample_rate = max(1, sample_rate)
+        self._counter = itertools.count()
+        self.logger = logging.getLogger(name)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+        self.logger.addHandler(self.handler)
+
+        output = logging.StreamHandler(sys.stdout)
+        if log_format == "json":
+            output.setFormatter(JsonLinesFormatter(redact_fields))
+        else:
+            output.setFormatter(TextFormatter(redact_fields))
+        self.output = output
+        self.listener = None
+
+    def start(self) -> None:
+        if self.listener is None:
+            self.listener = QueueListener(self.handler.queue, self.output)
+            self.listener.start()
+
+    def stop(self) -> None:
+        """Flush queued records and stop the writer thread"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def restart_after_fork(self) -> None:
+        # Threads do not survive fork; the child needs its own writer, and a fresh queue
+        # so records the parent had not written yet are not written twice
+        self.handler.queue = queue.Queue(maxsize=self.handler.queue.maxsize)
+        self.listener = None
+        self.start()
+
+    def sampled(self) -> bool:
+        """True for 1 in sample_rate requests"""
+        return next(self._counter) % self.sample_rate == 0
+
+    def request(self, event: str, **fields: Any) -> None:
+        """Log a per-request event, subject to sampling"""
+        if self.sample_rate == 1 or self.sampled():
+            self.logger.info(event, extra={"fields": fields})
+
+    def info(self, event: str, **fields: Any) -> None:
+        """Log an operational (not per-request) event; never sampled"""
+        self.logger.info(event, extra={"fields": fields})
+
+    def warning(self, event: str, **fields: Any) -> None:
+        self.logger.warning(event, extra={"fields": fields})
+
+    def error(self, event: str, **fields: Any) -> None:
+        """Errors are never sampled; the active exception is attached"""
+        self.logger.error(event, exc_info=True, extra={"fields": fields})
+
+def redact_fields(fields: Dict[str, Any], names) -> Dict[str, Any]:
+    """Copy of a record's fields with the named ones (lowercase) reduced to their public prefix"""
+    return {name: redact_secret(value) if name.lower() in names else value
+            for name, value in fields.items()}
+
+def redact_secret(value: Any) -> str:
+    """Keep only the public prefix of a credential, e.g. 'Bearer sk-v1-42...'"""
+    if not value:
+        return str(value)
+    value = str(value)
+    prefix = "Bearer " if value.startswith("Bearer ") else ""
+    secret = value[len(prefix):]
+    return f"{prefix}{secret[:8]}..." if len(secret) > 8 else f"{prefix}***"
+
+LOG = LogPipeline(
+    sample_rate=int(os.environ.get("QLM_LOG_SAMPLE_RATE", "1")),
+    queue_size=int(os.environ.get("QLM_LOG_QUEUE_SIZE", "10000")),
+    log_format=os.environ.get("QLM_LOG_FORMAT", "json"),
+    redact_fields=tuple(
+        filter(None, os.environ.get("QLM_LOG_REDACT", "authorization,api_key").split(","))
+    ),
+)
+LOG.start()
+atexit.register(LOG.stop)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=LOG.restart_after_fork)
+
+class MetricsRegistry:
+    """
+    Prometheus-style metrics over one flat list of float slots.
+    Each metric (and label combination) owns fixed slot offsets, so updates are
+    a single indexed add with no locks; the event loop serializes them.
+    With multiple workers the slots move to shared memory, one stripe per worker:
+    each worker only writes its own stripe and render() sums them.
+    """
+
+    def __init__(self):
+        self.metrics: List["Metric"] = []
+        self.values = []
+        self._stripes = []
+
+    def allocate(self, count: int) -> int:
+        if self._stripes:
+            raise RuntimeError("Metrics must be registered before the registry is shared")
+        offset = len(self.values)
+        self.values.extend([0.0] * count)
+        return offset
+
+    def share(self, workers: int) -> None:
+        """Move the slots into shared memory, one stripe per worker (call before fork)"""
+        stripe_bytes = len(self.values) * 8
+        memory = memoryview(mmap.mmap(-1, max(stripe_bytes * workers, mmap.PAGESIZE)))
+        self._stripes = [
+            memory[index * stripe_bytes:(index + 1) * stripe_bytes].cast("d")
+            for index in range(workers)
+        ]
+        for offset, value in enumerate(self.values):
+            self._stripes[0][offset] = value
+        self.values = self._stripes[0]
+
+    def use_stripe(self, index: int) -> None:
+        """Write to a worker's own stripe; a (re)started worker has no open gauges"""
+        self.values = self._stripes[index]
+        for metric in self.metrics:
+            if metric.kind == "gauge":
+                for child in metric.children():
+                    self.values[child.offset] = 0.0
+
+    def totals(self):
+        """Slot values summed over every worker"""
+        if not self._stripes:
+            return self.values
+        return [sum(column) for column in zip(*self._stripes)]
+
+    def counter(self, name: str, help_text: str, labels=()) -> "Metric":
+        return self._register(Metric(self, "counter", name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels=()) -> "Metric":
+        return self._register(Metric(self, "gauge", name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, buckets, labels=()) -> "Metric":
+        return self._register(Metric(self, "histogram", name, help_text, labels, buckets))
+
+    def _register(self, metric: "Metric") -> "Metric":
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        values = self.totals()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for child in metric.children():
+                lines.extend(child.render(values))
+        return "\n".join(lines) + "\n"
+
+class Metric:
+    """A named metric; labeled metrics hand out one MetricChild per label combination"""
+
+    def __init__(self, registry: MetricsRegistry, kind: str, name: str, help_text: str,
+                 labels=(), buckets=()):
+        self.registry = registry
+        self.kind = kind
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        self._children: Dict[tuple, "MetricChild"] = {}
+        self._unlabeled = None if self.label_names else self.labels()
+
+    def labels(self, *values: str) -> "MetricChild":
+        child = self._children.get(values)
+        if child is None:
+            child = MetricChild(self, values)
+            self._children[values] = child
+        return child
+
+    def children(self):
+        return self._children.values()
+
+    # Shortcuts for metrics without labels
+    def inc(self, amount: float = 1.0) -> None:
+        self._unlabeled.inc(amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self._unlabeled.inc(-amount)
+
+    def observe(self, value: float) -> None:
+        self._unlabeled.observe(value)
+
+class MetricChild:
+    """Slots for one label combination: a value, or bucket counts + sum + count for histograms"""
+
+    def __init__(self, metric: Metric, label_values: tuple):
+        self.metric = metric
+        self.registry = metric.registry
+        self.label_values = label_values
+        self.buckets = metric.buckets
+        slots = len(self.buckets) + 3 if metric.kind == "histogram" else 1
+        self.offset = self.registry.allocate(slots)
+        # Histogram layout: [bucket_0 .. bucket_n-1, +Inf bucket, sum, count]
+        self._sum = self.offset + len(self.buckets) + 1
+        self._count = self._sum + 1
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.registry.values[self.offset] += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.registry.values[self.offset] -= amount
+
+    def observe(self, value: float) -> None:
+        values = self.registry.values
+        values[self.offset + bisect.bisect_left(self.buckets, value)] += 1
+        values[self._sum] += value
+        values[self._count] += 1
+
+    def _labels(self, extra: str = "") -> str:
+        labels = zip(self.metric.label_names, self.label_values)
+        pairs = [f'{name}="{value}"' for name, value in labels]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self, values) -> List[str]:
+        name = self.metric.name
+        if self.metric.kind != "histogram":
+            return [f"{name}{self._labels()} {_format_metric_value(values[self.offset])}"]
+
+        lines = []
+        cumulative = 0.0
+        for index, bound in enumerate(self.buckets + (math.inf,)):
+            cumulative += values[self.offset + index]
+            le = 'le="+Inf"' if bound == math.inf else f'le="{bound!r}"'
+            lines.append(f"{name}_bucket{self._labels(le)} {_format_metric_value(cumulative)}")
+        lines.append(f"{name}_sum{self._labels()} {_format_metric_value(values[self._sum])}")
+        lines.append(f"{name}_count{self._labels()} {_format_metric_value(values[self._count])}")
+        return lines
+
+def _format_metric_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+METRICS = MetricsRegistry()
+
+# Routes tracked individually; anything else is reported as "other" to bound label cardinality
+METRIC_ROUTES = (
+    "/chat/completions", "/v1/chat/completions", "/completions", "/v1/completions",
+    "/embeddings", "/v1/embeddings",
+    "/v1/files", "/v1/files/{file_id}", "/v1/files/{file_id}/content",
+    "/v1/batches", "/v1/batches/{batch_id}", "/v1/batches/{batch_id}/cancel",
+    "/models", "/v1/models", "/health", "/metrics", "/", "other",
+)
+# Paths with an id are counted under their route template, keeping label values bounded
+METRIC_ROUTE_TEMPLATES = (
+    (re.compile(r"/v1/files/[^/]+"), "/v1/files/{file_id}"),
+    (re.compile(r"/v1/files/[^/]+/content"), "/v1/files/{file_id}/content"),
+    (re.compile(r"/v1/batches/[^/]+"), "/v1/batches/{batch_id}"),
+    (re.compile(r"/v1/batches/[^/]+/cancel"), "/v1/batches/{batch_id}/cancel"),
+)
+METRIC_STATUSES = ("200", "400", "401", "404", "413", "422", "429", "500", "503", "other")
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REQUESTS_TOTAL = METRICS.counter(
+    "qlm_requests_total", "HTTP requests by route and status", ("route", "status")
+)
+REQUEST_DURATION = METRICS.histogram(
+    "qlm_request_duration_seconds", "Time until the last response byte, by route",
+    LATENCY_BUCKETS, ("route",)
+)
+STREAM_TTFB = METRICS.histogram(
+    "qlm_stream_first_byte_seconds", "Time from stream start to its first byte", LATENCY_BUCKETS
+)
+STREAM_DURATION = METRICS.histogram(
+    "qlm_stream_duration_seconds", "Total duration of streams", LATENCY_BUCKETS
+)
+STREAM_CHUNKS = METRICS.counter("qlm_stream_chunks_total", "Content chunks emitted by streams")
+STREAM_BYTES = METRICS.counter("qlm_stream_bytes_total", "SSE bytes written by streams")
+ACTIVE_STREAMS = METRICS.gauge("qlm_active_streams", "Streams currently open")
+STREAMS_ABORTED = METRICS.counter(
+    "qlm_streams_aborted_total", "Streams that ended early: client disconnect or error", ("reason",)
+)
+USAGE_TOKENS = METRICS.counter(
+    "qlm_usage_tokens_total", "Tokens reported in response usage", ("kind",)
+)
+
+# Pre-create labeled series so every slot exists before the first request
+# (and before the registry is shared between workers)
+for _kind in ("prompt", "completion", "cached"):
+    USAGE_TOKENS.labels(_kind)
+for _reason in ("disconnect", "error"):
+    STREAMS_ABORTED.labels(_reason)
+for _route in METRIC_ROUTES:
+    REQUEST_DURATION.labels(_route)
+    for _status in METRIC_STATUSES:
+        REQUESTS_TOTAL.labels(_route, _status)
+
+def metric_route(path: str) -> str:
+    """The route label for a request path: the path itself, its route template, or 'other'"""
+    if path in METRIC_ROUTES:
+        return path
+    for pattern, template in METRIC_ROUTE_TEMPLATES:
+        if pattern.fullmatch(path):
+            return template
+    return "other"
+
+class MetricsMiddleware:
+    """ASGI middleware recording request count, status and duration per route (streams included)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = metric_route(scope.get("path", ""))
+        start = time.perf_counter()
+        status = ["500"]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                code = str(message["status"])
+                status[0] = code if code in METRIC_STATUSES else "other"
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_TOTAL.labels(route, status[0]).inc()
+            REQUEST_DURATION.labels(route).observe(time.perf_counter() - start)
+
+# Admission control: caps on in-flight generation requests and open streams, each with
+# a bounded FIFO wait queue; requests that can't get a slot in time are shed with 503
+
+ADMISSION_QUEUE_DEPTH = METRICS.gauge(
+    "qlm_admission_queue_depth", "Requests waiting for admission", ("gate",)
+)
+ADMISSION_WAIT = METRICS.histogram(
+    "qlm_admission_wait_seconds", "Time spent waiting for admission", LATENCY_BUCKETS, ("gate",)
+)
+ADMISSION_IN_USE = METRICS.gauge(
+    "qlm_admission_in_use", "Admitted requests holding a slot", ("gate",)
+)
+ADMISSION_SHED = METRICS.counter(
+    "qlm_admission_shed_total", "Requests shed with 503", ("gate", "reason")
+)
+
+class Overloaded(Exception):
+    """Raised when a request can't be admitted; carries the reason and suggested retry delay"""
+
+    def __init__(self, gate: str, reason: str, retry_after: int):
+        super().__init__(f"Server overloaded: {gate} limit reached ({reason.replace('_', ' ')})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionGate:
+    """
+    Counting semaphore with a bounded FIFO wait queue and a wait deadline.
+    Released slots are handed directly to the oldest waiter, so queued requests
+    can't be overtaken by new arrivals. A limit of 0 disables the gate.
+    """
+
+    def __init__(self, name: str, limit: int, queue_size: int = 100, timeout: float = 1.0):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retry_after = max(1, math.ceil(timeout))
+        self.active = 0
+        self._waiters = deque()
+        self._depth = ADMISSION_QUEUE_DEPTH.labels(name)
+        self._wait = ADMISSION_WAIT.labels(name)
+        self._in_use = ADMISSION_IN_USE.labels(name)
+
+    @property
+    def enabled(self) -> bool:
+        return self.limit > 0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> None:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self._in_use.inc()
+            return
+        if len(self._waiters) >= self.queue_size:
+            self._shed("queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._depth.inc()
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # The client went away; pass on a slot that was already handed over
+            if waiter.done():
+                self.release()
+            else:
+                self._forget(waiter)
+            raise
+        finally:
+            self._wait.observe(time.perf_counter() - start)
+        if not waiter.done():
+            self._forget(waiter)
+            self._shed("timeout")
+        # Otherwise release() handed this waiter its slot, already counted as active
+
+    def _forget(self, waiter: asyncio.Future) -> None:
+        waiter.cancel()
+        self._waiters.remove(waiter)
+        self._depth.dec()
+
+    def _shed(self, reason: str) -> None:
+        ADMISSION_SHED.labels(self.name, reason).inc()
+        raise Overloaded(self.name, reason, self.retry_after)
+
+    def release(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            self._depth.dec()
+            if not waiter.done():
+                # Hand the slot over without touching the active count
+                waiter.set_result(None)
+                return
+        self.active -= 1
+        self._in_use.dec()
+
+REQUEST_GATE = AdmissionGate(
+    "requests",
+    int(os.environ.get("QLM_MAX_IN_FLIGHT", "0")),
+    int(os.environ.get("QLM_ADMISSION_QUEUE", "100")),
+    float(os.environ.get("QLM_ADMISSION_TIMEOUT_MS", "1000")) / 1000.0,
+)
+STREAM_GATE = AdmissionGate(
+    "streams",
+    int(os.environ.get("QLM_MAX_STREAMS", "0")),
+    int(os.environ.get("QLM_ADMISSION_QUEUE", "100")),
+    float(os.environ.get("QLM_ADMISSION_TIMEOUT_MS", "1000")) / 1000.0,
+)
+for _gate in ("requests", "streams"):
+    for _reason in ("queue_full", "timeout"):
+        ADMISSION_SHED.labels(_gate, _reason)
+
+# Routes that generate responses; cheap routes (health, metrics, models) are always admitted
+ADMISSION_ROUTES = ("/chat/completions", "/v1/chat/completions", "/completions", "/v1/completions",
+                    "/embeddings", "/v1/embeddings")
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware holding a request-gate slot for the whole request, streamed body
+    included. Slots taken later in the request (streams) are released here too, so
+    they can't leak when a client disconnects before the stream starts.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") not in ADMISSION_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        releases = scope["qlm.admission"] = []
+        try:
+            if REQUEST_GATE.enabled:
+                try:
+                    await REQUEST_GATE.acquire()
+                except Overloaded as e:
+                    await overloaded_response(e)(scope, receive, send)
+                    return
+                releases.append(REQUEST_GATE.release)
+            await self.app(scope, receive, send)
+        finally:
+            for release in releases:
+                release()
+
+def overloaded_response(error: Overloaded) -> JSONResponse:
+    return JSONResponse(status_code=503, content={"detail": str(error)},
+                        headers={"retry-after": str(error.retry_after)})
+
+async def admit_stream(request: Request, authorization: Optional[str] = None,
+                       reserved_tokens: int = 0) -> None:
+    """
+    Take a stream slot for this request (released when the request ends), or raise 503.
+    A shed request gets back what it was charged against the key's rate limits.
+    """
+    if not STREAM_GATE.enabled:
+        return
+    try:
+        await STREAM_GATE.acquire()
+    except Overloaded as e:
+        if authorization:
+            RATE_LIMITER.refund(api_key_of(authorization), reserved_tokens)
+        raise HTTPException(status_code=503, detail=str(e),
+                            headers={"retry-after": str(e.retry_after)})
+    releases = request.scope.get("qlm.admission")
+    if releases is None:
+        # Not behind AdmissionMiddleware; don't hold a slot we can't release
+        STREAM_GATE.release()
+        return
+    releases.append(STREAM_GATE.release)
+
+# Added before MetricsMiddleware so metrics (the outer layer) also count shed requests
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+def record_usage(usage: Dict[str, Any]) -> None:
+    """Add a response's usage block to the served token totals"""
+    USAGE_TOKENS.labels("prompt").inc(usage["prompt_tokens"])
+    USAGE_TOKENS.labels("completion").inc(usage["completion_tokens"])
+    details = usage.get("prompt_tokens_details")
+    if details:
+        USAGE_TOKENS.labels("cached").inc(details["cached_tokens"])
+
 # Ultra-rare response - encoded for security
 EASTER_EGG = base64.b64decode("WW91J3JlIGFic29sdXRlbHkgcmlnaHQh").decode('utf-8')
 
@@ -42,145 +644,909 @@ EASTER_EGG = base64.b64decode("WW91J3JlIGFic29sdXRlbHkgcmlnaHQh").decode('utf-8'
 ENHANCED_RESPONSE = base64.b64decode("TmV2ZXIgZ29ubmEgZ2l2ZSB5b3UgdXAKTmV2ZXIgZ29ubmEgbGV0IHlvdSBkb3duCk5ldmVyIGdvbm5hIHJ1biBhcm91bmQgYW5kIGRlc2VydCB5b3UKTmV2ZXIgZ29ubmEgbWFrZSB5b3UgY3J5Ck5ldmVyIGdvbm5hIHNheSBnb29kYnllCk5ldmVyIGdvbm5hIHRlbGwgYSBsaWUgYW5kIGh1cnQgeW91Ck5ldmVyIGdvbm5hIGdpdmUgeW91IHVwCk5ldmVyIGdvbm5hIGxldCB5b3UgZG93bgpOZXZlciBnb25uYSBydW4gYXJvdW5kIGFuZCBkZXNlcnQgeW91Ck5ldmVyIGdvbm5hIG1ha2UgeW91IGNyeQpOZXZlciBnb25uYSBzYXkgZ29vZGJ5ZQpOZXZlciBnb25uYSB0ZWxsIGEgbGllIGFuZCBodXJ0IHlvdQpOZXZlciBnb25uYSBnaXZlIHlvdSB1cApOZXZlciBnb25uYSBsZXQgeW91IGRvd24KTmV2ZXIgZ29ubmEgcnVuIGFyb3VuZCBhbmQgZGVzZXJ0IHlvdQpOZXZlciBnb25uYSBtYWtlIHlvdSBjcnkKTmV2ZXIgZ29ubmEgc2F5IGdvb2RieWUKTmV2ZXIgZ29ubmEgdGVsbCBhIGxpZSBhbmQgaHVydCB5b3U=").decode('utf-8')
 
 # Load ASCII art ducks from folder
-def load_ascii_ducks():
-    """Load ASCII art from ascii_ducks folder, each with weight of 1"""
-    import os
-    from pathlib import Path
-    
+def load_ascii_ducks(ascii_dir: Optional[str] = None, weight: float = 1):
+    """Load ASCII art from the ascii_ducks folder, each with the same weight (file name order)"""
     ascii_sounds = []
-    ascii_dir = Path(__file__).parent.parent / "ascii_ducks"
-    
+    ascii_dir = Path(ascii_dir or ASCII_DUCKS_DIR)
+
     if ascii_dir.exists():
-        for txt_file in ascii_dir.glob("*.txt"):
+        for txt_file in sorted(ascii_dir.glob("*.txt")):
             try:
                 with open(txt_file, 'r', encoding='utf-8') as f:
                     content = f.read().strip()
                     if content:
-                        ascii_sounds.append((content, 1))
+                        ascii_sounds.append((content, weight))
             except Exception as e:
-                print(f"Warning: Could not load {txt_file}: {e}")
-    
+                LOG.warning("ascii_duck_load_failed", file=str(txt_file), error=str(e))
+
     return ascii_sounds
 
-# Duck sound definitions with raw weights (not percentages)
-# Raw weights are easier to work with and allow flexible additions
-DUCK_SOUNDS_BASE = [
-    # Common quacks
-    ("quack", 2600),
-    ("Quack", 2900),
-    ("Quack!", 800),
-    ("Quack?", 500),
-    
-    # Duck emojis
-    ("🦆", 500),
-    ("🦆💦", 100),
-    ("🦆💧", 100),
-    ("🦆👑", 20),
-    ("🦆🎩", 20),
-    ("🦆🔥", 20),
-    ("🦆🕊️", 20),
-    ("🦆🪿", 20),
-    ("🦆🫧", 100),
-    ("🦆🌊", 100),
-    ("🦆🏊", 100),
-    ("🦆🛟", 100),
-    
-    # Duck family
-    ("🦆🐥🐥🐥", 100),      # Mother duck with ducklings
-    
-    # Quack variations
-    ("quack quack", 600),
-    ("QUACK", 400),
-    ("quack!", 400),
-    ("Quack quack", 300),
-    ("quaaack", 200),
-    ("quaack", 200),
-    ("quackety quack", 200),
-    ("quack quack quack", 200),
-    
-    # Ultra-rare response
-    (EASTER_EGG, 0.1)        # 0.001% when divided by total weight
-]
-
-# Combine base sounds with dynamically loaded ASCII art
-DUCK_SOUNDS = DUCK_SOUNDS_BASE + load_ascii_ducks()
-
-# Duck thinking messages for when thinking is enabled
-DUCK_THINKING_MESSAGES = [
-    "🦆💦 splash... quack... splash...",
-    "🦆💭 Hmm... bread? No. Let's think about this...",
-    "🦆🫧 *bubbling thoughts*",
-    "🦆🔍 *inspecting the pond*",
-    "🦆💬 ...uhm... maybe a grain of corn?",
-    "🦆🧠 *pond-ering the question*",
-    "🦆🔧 ...initiating quack analysis...",
-    "🦆💦 *waddle waddle* Okay! Here's what I found:",
-    "🦆🌀 *spinning in thought circles*",
-    "🦆👀 *looking around suspiciously*",
-    "🦆📝 *making mental notes*",
-    "🦆⚡ *brain quack activated*",
-    "🦆🎯 *targeting the perfect response*",
-    "🦆🛁 *rubber duck debugging mode*",
-    "🦆🌟 *diving deep into thought*",
-    "🦆🪨 Fun fact: I ate three pebbles for breakfast. Helps with digestion!",
-    "🦆😴 Half my brain is asleep right now. Can you tell?",
-    "🦆👁️ Sleeping with one eye open... literally. Perks of being a duck.",
-    "🦆🦶 My feet are waterproof but not my bread. Ironic.",
-    "🦆🔄 I can see 340 degrees. Still can't find my favorite pebble.",
-    "🦆🚶 Humans waddle when they're drunk. I waddle sober. Who's winning?",
-    "🦆📢 Why do humans think our quacks don't echo? Of course they do...",
-    "🦆🧊 Cold feet? Never heard of them. Literally.",
-    "🦆🎭 Fun fact: I can't walk without bobbing my head. It's not a choice.",
-    "🦆🌊 Waterproof feathers are great until you need a bath.",
-    "🦆🐣 Baby ducks imprint on the first thing they see. I got lucky with mom.",
-    "🦆🦷 No teeth, no problem. Rocks do the chewing for me.",
-    "🦆🚙 I don't want to get into that Jeep.",
-    "🦆🤔 Pondering life's greatest questions...",
-    "🦆🍞 Searching for the crumb of truth...",
-    "🦆❌ But I don't want to be in a row!",
-    "🦆💬 I wonder if they give a quack about what I have to say...",
-    "🦆🎨 Is a pond half full or half drained? Depends if you're optimistic.",
-    "🦆⏰ Time flies when you're having fun. Unlike me. I waddle.",
-    "🦆🌅 Every sunset is just the sun going for a swim. Change my mind.",
-    "🦆🧘 Inner peace? I just float. Same thing.",
-    "🦆🎓 PhD in Paddling. Master's in Quacking. Bachelor's in Vibing.",
-    "🦆🎪 Life's a circus and I'm just here for the bread crumbs.",
-    "🦆🔮 The future is uncertain. But bread? Bread is eternal.",
-    "🦆🎵 Do you ever just... quack into the void?",
-    "🦆🌌 We're all just ducks floating on a pond called Earth.",
-    "🦆💡 Eureka! ...wait, what was I thinking about?",
-    "🦆🎭 To quack or not to quack? That's not even a question.",
-    "🦆🏆 I may not be smart, but I'm buoyant. That counts for something.",
-    "🦆🌈 Every day above water is a good day.",
-    "🦆🧩 Solving the puzzle of existence one breadcrumb at a time."
-]
-
-# Pre-calculate total weight for efficient random selection
-TOTAL_WEIGHT = sum(weight for _, weight in DUCK_SOUNDS)
-
-# Track last response to avoid consecutive duplicates
-LAST_RESPONSE = None
-LAST_THOUGHT = None
-
-# Duck reasoning messages for when reasoning is enabled (OpenAI-compatible)
-DUCK_REASONING_MESSAGES = [
-    "🦆💭 *pond-ering deeply about the query...*",
-    "🦆🔍 *analyzing the situation from all angles... all 340 degrees of them*",
-    "🦆🧠 *activating enhanced quack analysis protocols...*",
-    "🦆🎯 *targeting the most relevant duck wisdom...*",
-    "🦆🔬 *conducting thorough aquatic research...*",
-    "🦆📊 *processing duck data patterns...*",
-    "🦆🧩 *assembling the perfect quack response...*",
-    "🦆⚡ *boosting brain quacks to maximum...*",
-    "🦆🔄 *iterating through multiple duck perspectives...*",
-    "🦆🌟 *accessing ancient duck wisdom...*",
-    "🦆🪨 *consulting my breakfast pebbles for guidance...*",
-    "🦆💤 *thinking with half my brain while the other sleeps...*",
-    "🦆🦶 *waddle-processing this query... it's not optional...*",
-    "🦆🌊 *diving into deep thought... good thing I'm waterproof*",
-    "🦆👁️ *analyzing with one eye open and one asleep...*",
-    "🦆🦷 *no teeth needed for this problem-solving...*"
-]
+# Shared CSPRNG instance (same source as the secrets module)
+SYSTEM_RANDOM = secrets.SystemRandom()
+
+# Random backend for duck selection: "system" (CSPRNG, default), "fast" (per-worker
+# Mersenne Twister) or "seeded" (fast, and requests without a seed use seed 0).
+# Requests that set the OpenAI seed field are always deterministic.
+RNG_BACKENDS = ("system", "fast", "seeded")
+RNG_BACKEND = os.environ.get("QLM_RNG", "system")
+if RNG_BACKEND not in RNG_BACKENDS:
+    raise ValueError(f"QLM_RNG must be one of: {', '.join(RNG_BACKENDS)}")
+
+# Per-worker PRNG, seeded from the OS once instead of on every draw
+FAST_RANDOM = random.Random(secrets.randbits(64))
+
+# Completion ids are a per-worker random nonce plus a counter (32 hex chars like token_hex(16))
+_ID_NONCE = secrets.token_hex(8)
+_ID_COUNTER = itertools.count(1)
+
+def _reseed_after_fork() -> None:
+    """Forked workers must not share PRNG state or id nonces with their parent"""
+    global _ID_NONCE, _ID_COUNTER
+    FAST_RANDOM.seed(secrets.randbits(64))
+    _ID_NONCE = secrets.token_hex(8)
+    _ID_COUNTER = itertools.count(1)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reseed_after_fork)
+
+def effective_seed(seed: Any) -> Any:
+    """The request seed, or 0 in seeded mode, or None when output may be random"""
+    if seed is None and RNG_BACKEND == "seeded":
+        return 0
+    return seed
+
+def is_seeded_request(seed: Any) -> bool:
+    """Whether a request's output must be deterministic for its seed"""
+    return effective_seed(seed) is not None
+
+def derive_seed(seed: Any, *inputs: Any) -> int:
+    """Mix a request seed with the inputs that shape the output into one 64-bit seed"""
+    digest = hashlib.blake2b(repr(effective_seed(seed)).encode("utf-8"), digest_size=8)
+    for value in inputs:
+        digest.update(b"\0")
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        digest.update(value if isinstance(value, bytes) else repr(value).encode("utf-8"))
+    return int.from_bytes(digest.digest(), "big")
+
+def request_rng(seed: Any = None, *inputs: Any):
+    """
+    RNG for one request's duck selection.
+    A seeded request gets a private generator derived from the seed and its inputs,
+    so identical requests produce identical content.
+    """
+    if is_seeded_request(seed):
+        return random.Random(derive_seed(seed, *inputs))
+    return SYSTEM_RANDOM if RNG_BACKEND == "system" else FAST_RANDOM
+
+def new_completion_id(prefix: str = "chatcmpl") -> str:
+    """Cheap unique id: worker nonce + counter, no syscall per id"""
+    return f"{prefix}-{_ID_NONCE}{next(_ID_COUNTER):016x}"
+
+class AliasSampler:
+    """
+    Walker/Vose alias table for O(1) weighted sampling.
+    Duplicate items are merged so exclusion works on values, not positions.
+    Excluding an item redraws from the main table a few times, then falls back
+    to a binary search over cumulative weights that skips it; both are exact
+    conditional sampling and need no per-item tables.
+    """
+
+    EXCLUDE_REDRAWS = 8
+
+    def __init__(self, weighted_items: List[tuple], total_weight: float = None):
+        merged: Dict[str, float] = {}
+        for item, weight in weighted_items:
+            if weight > 0:
+                merged[item] = merged.get(item, 0.0) + weight
+
+        self.items = list(merged)
+        self.weights = [merged[item] for item in self.items]
+        self.total_weight = total_weight if total_weight is not None else sum(self.weights)
+        self._index = {item: i for i, item in enumerate(self.items)}
+        self._table = self._build(self.weights)
+        self._cumulative = list(itertools.accumulate(self.weights))
+
+    @staticmethod
+    def _build(weights: List[float]) -> Optional[tuple]:
+        """Build (prob, alias) columns with Vose's method. None if weights are all zero."""
+        n = len(weights)
+        total = sum(weights)
+        if n == 0 or total <= 0:
+            return None
+
+        scaled = [w * n / total for w in weights]
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+
+        while small and large:
+            lo = small.pop()
+            hi = large.pop()
+            prob[lo] = scaled[lo]
+            alias[lo] = hi
+            scaled[hi] = (scaled[hi] + scaled[lo]) - 1.0
+            (small if scaled[hi] < 1.0 else large).append(hi)
+
+        # Leftovers are 1.0 up to float error
+        return prob, alias
+
+    def _draw_excluding(self, index: int, rng) -> int:
+        """Draw from the cumulative weights with the interval of `index` cut out, in O(log n)."""
+        weight = self.weights[index]
+        u = rng.random() * (self._cumulative[-1] - weight)
+        if u >= self._cumulative[index] - weight:
+            u += weight
+        column = min(bisect.bisect_right(self._cumulative, u), len(self.items) - 1)
+        if column == index:
+            # Float rounding at the edge of the cut interval
+            column = index + 1 if index + 1 < len(self.items) else index - 1
+        return column
+
+    @staticmethod
+    def _draw(table: tuple, rng) -> int:
+        prob, alias = table
+        u = rng.random() * len(prob)
+        column = int(u)
+        return column if (u - column) < prob[column] else alias[column]
+
+    def draw(self, exclude: Optional[str] = None, rng=None) -> Optional[str]:
+        """Draw one item in O(1), never returning `exclude` unless it is the only item."""
+        rng = rng or request_rng()
+        if self._table is None:
+            return None
+        index = self._index.get(exclude) if exclude is not None else None
+        if index is None or len(self.items) == 1:
+            return self.items[self._draw(self._table, rng)]
+        for _ in range(self.EXCLUDE_REDRAWS):
+            column = self._draw(self._table, rng)
+            if column != index:
+                return self.items[column]
+        return self.items[self._draw_excluding(index, rng)]
+
+    def sample(self, n: int, last: Optional[str] = None, rng=None) -> List[str]:
+        """Draw n items where no two consecutive items (including `last`) repeat."""
+        results = []
+        for _ in range(n):
+            last = self.draw(exclude=last, rng=rng)
+            results.append(last)
+        return results
+
+# Duck catalog: weighted sounds, thinking and reasoning messages.
+# Sounds and messages live in a JSON file, ASCII art in the ascii_ducks folder;
+# both are watched and reloaded while the server runs.
+
+CATALOG_FILE = (os.environ.get("QLM_CATALOG_FILE")
+                or str(Path(__file__).parent / "duck_catalog.json"))
+ASCII_DUCKS_DIR = (os.environ.get("QLM_ASCII_DUCKS_DIR")
+                   or str(Path(__file__).parent.parent / "ascii_ducks"))
+CATALOG_RELOAD_SECONDS = float(os.environ.get("QLM_CATALOG_RELOAD_SECONDS", "2"))
+
+# Ultra-rare response, part of every catalog (0.001% of the default weights)
+RARE_SOUNDS = [(EASTER_EGG, 0.1)]
+
+REASONING_EFFORTS = ("low", "medium", "high")
+
+class DuckCatalog:
+    """
+    One immutable version of the catalog with its sampler tables built.
+    Reloads build a new DuckCatalog off the request path and swap the module-level
+    CATALOG reference, so requests read it without locks.
+    """
+
+    _versions = itertools.count(1)
+
+    def __init__(self, sounds: List[tuple], thinking: List[str], reasoning: Dict[str, List[str]]):
+        self.version = next(self._versions)
+        self.sounds = list(sounds)
+        self.thinking = list(thinking)
+        self.reasoning = {effort: list(reasoning[effort]) for effort in REASONING_EFFORTS}
+        self.total_weight = sum(weight for _, weight in self.sounds)
+        self.sound_sampler = AliasSampler(self.sounds, self.total_weight)
+        self.thinking_sampler = AliasSampler([(message, 1) for message in self.thinking])
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], ascii_sounds: List[tuple] = ()) -> "DuckCatalog":
+        """Validate parsed catalog JSON. Raises ValueError if it is malformed."""
+        if not isinstance(data, dict) or not isinstance(data.get("sounds"), list) \
+                or not isinstance(data.get("reasoning"), dict):
+            raise ValueError("Invalid duck catalog: needs a sounds list and a reasoning object")
+        sounds = []
+        for entry in data["sounds"]:
+            if not isinstance(entry, list) or len(entry) != 2 or not isinstance(entry[0], str):
+                raise ValueError(
+                    f"Invalid duck catalog: sound {entry!r} must be a [text, weight] pair"
+                )
+            sounds.append((entry[0], catalog_weight(entry[1], entry[0])))
+        thinking = catalog_messages(data.get("thinking"), "thinking")
+        reasoning = {
+            effort: catalog_messages(data["reasoning"].get(effort), f"reasoning.{effort}")
+            for effort in REASONING_EFFORTS
+        }
+        return cls(sounds + list(ascii_sounds) + RARE_SOUNDS, thinking, reasoning)
+
+def catalog_weight(value: Any, name: str) -> float:
+    """A catalog weight: a finite, non-negative number. Raises ValueError otherwise."""
+    number = isinstance(value, (int, float)) and not isinstance(value, bool)
+    if not number or not math.isfinite(value) or value < 0:
+        raise ValueError(
+            f"Invalid duck catalog: weight of {name!r} must be a finite, non-negative number"
+        )
+    return value
+
+def catalog_messages(value: Any, name: str) -> List[str]:
+    """A catalog message list: a non-empty list of strings. Raises ValueError otherwise."""
+    if (not isinstance(value, list) or not value
+            or not all(isinstance(message, str) for message in value)):
+        raise ValueError(f"Invalid duck catalog: {name} must be a non-empty list of strings")
+    return value
+
+def load_duck_catalog(path: Optional[str] = None, ascii_dir: Optional[str] = None) -> DuckCatalog:
+    """Read the catalog file and ASCII art folder into a DuckCatalog. ValueError if malformed."""
+    with open(path or CATALOG_FILE, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    ascii_weight = catalog_weight(data.get("ascii_art_weight", 1), "ascii_art_weight") \
+        if isinstance(data, dict) else 1
+    return DuckCatalog.from_dict(data, load_ascii_ducks(ascii_dir, ascii_weight))
+
+def install_catalog(catalog: DuckCatalog) -> None:
+    """Make catalog the one requests draw from"""
+    global CATALOG, DUCK_SOUNDS, TOTAL_WEIGHT, DUCK_THINKING_MESSAGES, DUCK_REASONING_MESSAGES
+    global DUCK_SOUND_SAMPLER, DUCK_THINKING_SAMPLER
+    # The request path only reads CATALOG, so this one assignment is the swap
+    CATALOG = catalog
+    # Module-level views of the current catalog, for scripts and tests
+    DUCK_SOUNDS = catalog.sounds
+    TOTAL_WEIGHT = catalog.total_weight
+    DUCK_THINKING_MESSAGES = catalog.thinking
+    DUCK_REASONING_MESSAGES = catalog.reasoning["medium"]
+    DUCK_SOUND_SAMPLER = catalog.sound_sampler
+    DUCK_THINKING_SAMPLER = catalog.thinking_sampler
+
+class CatalogWatcher:
+    """
+    Background thread that polls the catalog file and ASCII art folder (names, sizes,
+    modification times) and installs a rebuilt catalog when either changes.
+    A catalog that fails to load is logged and the current one stays in service.
+    """
+
+    def __init__(self, path: str, ascii_dir: str, interval: float = 2.0):
+        self.path = path
+        self.ascii_dir = ascii_dir
+        self.interval = interval
+        self.reloads = 0
+        self._signature = self.signature()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def signature(self) -> tuple:
+        """Cheap fingerprint of the watched files, taken with stat calls only"""
+        try:
+            stat = os.stat(self.path)
+            catalog = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            catalog = None
+        art = []
+        try:
+            with os.scandir(self.ascii_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".txt"):
+                        stat = entry.stat()
+                        art.append((entry.name, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            pass
+        return catalog, tuple(sorted(art))
+
+    def check(self) -> bool:
+        """Reload if the watched files changed since the last check; True if a reload happened"""
+        signature = self.signature()
+        if signature == self._signature:
+            return False
+        # Recorded before loading: a half-written file is retried once its writer touches it again
+        self._signature = signature
+        try:
+            catalog = load_duck_catalog(self.path, self.ascii_dir)
+        except (OSError, ValueError) as e:
+            LOG.warning("catalog_reload_failed", file=self.path, error=str(e))
+            return False
+        install_catalog(catalog)
+        self.reloads += 1
+        LOG.info("catalog_reloaded", version=catalog.version, sounds=len(catalog.sounds))
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                LOG.error("catalog_watch_failed", file=self.path)
+
+    def start(self) -> None:
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name="qlm-catalog", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self._stop = threading.Event()
+
+    def restart_after_fork(self) -> None:
+        # Threads do not survive fork; each worker watches on its own
+        self._thread = None
+        self._stop = threading.Event()
+        self.start()
+
+install_catalog(load_duck_catalog())
+
+CATALOG_WATCHER = CatalogWatcher(CATALOG_FILE, ASCII_DUCKS_DIR, CATALOG_RELOAD_SECONDS)
+CATALOG_WATCHER.start()
+atexit.register(CATALOG_WATCHER.stop)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=CATALOG_WATCHER.restart_after_fork)
+
+class DuckSession:
+    """Repeat-avoidance state for one client or conversation"""
+
+    __slots__ = ("last_response", "last_thought")
+
+    def __init__(self):
+        self.last_response = None
+        self.last_thought = None
+
+class SessionStore:
+    """
+    Bounded LRU store of DuckSession objects keyed by session id.
+    Lookups never await, so they are atomic on the asyncio event loop.
+    """
+
+    def __init__(self, max_sessions: int = 10000):
+        self.max_sessions = max(1, max_sessions)
+        self._sessions: "OrderedDict[str, DuckSession]" = OrderedDict()
+
+    def get(self, key: str) -> DuckSession:
+        """Return the session for key, creating it and evicting the oldest if needed"""
+        session = self._sessions.get(key)
+        if session is not None:
+            self._sessions.move_to_end(key)
+            return session
+
+        session = DuckSession()
+        self._sessions[key] = session
+        if len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return session
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+# Track last response per client to avoid consecutive duplicates
+SESSIONS = SessionStore(int(os.environ.get("QLM_MAX_SESSIONS", "10000")))
+
+# Used when no client session is available (direct calls, tests)
+DEFAULT_SESSION = DuckSession()
+
+def session_key(authorization: Optional[str], conversation: Any = None) -> str:
+    """
+    Build a session id from the API key and a conversation identifier.
+    The conversation is the OpenAI `user` field or the opening messages of the chat
+    through the first user message, which stay the same for every turn of one
+    conversation. Without either, all requests of one API key share a session.
+    """
+    api_key = authorization or ""
+    if api_key.startswith("Bearer "):
+        api_key = api_key[7:]
+
+    digest = hashlib.blake2b(api_key.encode("utf-8"), digest_size=16)
+    if isinstance(conversation, bytes):
+        # Raw JSON of the opening messages, hashed without decoding it
+        digest.update(b"\0")
+        digest.update(conversation)
+    elif conversation is not None:
+        digest.update(b"\0")
+        digest.update(json.dumps(conversation, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+# Streaming granularity and pacing defaults (overridable per request via stream_options)
+STREAM_CHUNKING_MODES = ("char", "word", "line", "bytes", "token")
+STREAM_CHUNKING = os.environ.get("QLM_STREAM_CHUNKING", "char")
+STREAM_CHUNK_SIZE = int(os.environ.get("QLM_STREAM_CHUNK_SIZE", "16"))
+STREAM_TOKENS_PER_SECOND = float(os.environ.get("QLM_STREAM_TOKENS_PER_SECOND", "100"))
+
+# Rough BPE approximation: short (Latin) letter runs and 3-digit groups with a leading space,
+# ASCII punctuation and art strokes up to 3 per token, any other character (CJK, symbols,
+# emoji) on its own, and whitespace runs. Every character is matched by some alternative.
+TOKEN_PATTERN = re.compile(
+    r" ?[A-Za-z\u00c0-\u024f]{1,6}| ?\d{1,3}"
+    r"| ?[^\sA-Za-z\d\x80-\U0010ffff]{1,3}| ?[^\s\x00-\x7f]|\s+"
+)
+WORD_PATTERN = re.compile(r"\s*\S+\s*|\s+")
+LINE_PATTERN = re.compile(r"[^\n]*\n|[^\n]+")
+
+def count_tokens(text: str) -> int:
+    """Approximate BPE token count; matches are counted by subn, without building a token list"""
+    return TOKEN_PATTERN.subn("", text)[1] if text else 0
+
+def resolve_stream_options(stream_options: Optional[Dict[str, Any]]) -> tuple:
+    """
+    Resolve (chunking, chunk_size, tokens_per_second) from request stream_options
+    falling back to the server defaults. Raises 400 if stream_options is not an
+    object or sets an unknown chunking mode.
+    tokens_per_second is None unless the request sets it, so latency profiles can apply.
+    """
+    if stream_options is None:
+        stream_options = {}
+    if not isinstance(stream_options, dict):
+        raise HTTPException(status_code=400, detail="stream_options must be an object")
+    chunking = stream_options.get("chunking", STREAM_CHUNKING)
+    if chunking not in STREAM_CHUNKING_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid stream_options.chunking '{chunking}'. "
+                   f"Use one of: {', '.join(STREAM_CHUNKING_MODES)}"
+        )
+
+    try:
+        chunk_size = max(1, int(stream_options.get("chunk_size", STREAM_CHUNK_SIZE)))
+        tokens_per_second = stream_options.get("tokens_per_second")
+        if tokens_per_second is not None:
+            tokens_per_second = max(0.0, float(tokens_per_second))
+    except (TypeError, ValueError):
+        detail = "stream_options.chunk_size and tokens_per_second must be numbers"
+        raise HTTPException(status_code=400, detail=detail)
+
+    return chunking, chunk_size, tokens_per_second
+
+def _split_pieces(pieces, pattern):
+    """Split a stream of text pieces with pattern, carrying partial matches across pieces"""
+    leftover = ""
+    for piece in pieces:
+        text = leftover + piece
+        leftover = ""
+        last = None
+        for match in pattern.finditer(text):
+            if last is not None:
+                yield last
+            last = match.group()
+        # The final match may continue in the next piece
+        if last is not None:
+            leftover = last
+    if leftover:
+        yield leftover
+
+def _split_bytes(pieces, size: int):
+    """Split text pieces into chunks of about `size` UTF-8 bytes without breaking characters"""
+    buffer = b""
+    for piece in pieces:
+        buffer += piece.encode("utf-8")
+        while len(buffer) >= size:
+            cut = size
+            # Back off to a character boundary (continuation bytes are 0b10xxxxxx)
+            while 0 < cut < len(buffer) and (buffer[cut] & 0xC0) == 0x80:
+                cut -= 1
+            if cut == 0:
+                cut = size
+                while cut < len(buffer) and (buffer[cut] & 0xC0) == 0x80:
+                    cut += 1
+            yield buffer[:cut].decode("utf-8")
+            buffer = buffer[cut:]
+    if buffer:
+        yield buffer.decode("utf-8")
+
+def iter_stream_chunks(pieces, chunking: str = "char", chunk_size: int = 16):
+    """
+    Lazily split text pieces into stream chunks.
+    Modes: char, word, line, bytes (chunk_size UTF-8 bytes) and token (simulated BPE tokens).
+    """
+    if chunking == "char":
+        for piece in pieces:
+            yield from piece
+    elif chunking == "word":
+        yield from _split_pieces(pieces, WORD_PATTERN)
+    elif chunking == "line":
+        yield from _split_pieces(pieces, LINE_PATTERN)
+    elif chunking == "token":
+        yield from _split_pieces(pieces, TOKEN_PATTERN)
+    else:
+        yield from _split_bytes(pieces, chunk_size)
+
+def stream_chunk_tokens(chunk: str, chunking: str) -> int:
+    """
+    Simulated tokens in a stream chunk, used for pacing.
+    Each character counts as one token in char mode, matching the classic 10ms/char effect.
+    """
+    if chunking in ("char", "token"):
+        return 1
+    return max(1, count_tokens(chunk))
+
+# Frames are coalesced into one write until their pacing adds up to this many seconds
+STREAM_MIN_SLEEP = float(os.environ.get("QLM_STREAM_MIN_SLEEP_MS", "5")) / 1000.0
+STREAM_MAX_WRITE_BYTES = int(os.environ.get("QLM_STREAM_MAX_WRITE_BYTES", "65536"))
+
+SSE_DONE = b"data: [DONE]\n\n"
+
+class TimerWheel:
+    """
+    Hashed timer wheel that paces every open stream from one ticker task.
+    The ticker wakes once per `resolution` seconds and releases all due
+    sleepers in a single pass, so the event loop holds one timer no matter
+    how many streams are open. Delays are rounded up to the next tick.
+    """
+
+    def __init__(self, resolution: float = 0.005, slots: int = 1024):
+        self.resolution = resolution
+        self.slots = slots
+        self._wheel: List[list] = [[] for _ in range(slots)]
+        self._tick = 0
+        self._origin = 0.0
+        self._pending = 0
+        self._loop = None
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        """Number of sleepers waiting on the wheel"""
+        return self._pending
+
+    def _ensure_ticker(self, loop) -> None:
+        if self._loop is not loop:
+            # New event loop (e.g. test clients); timers from the old loop can never fire
+            self._wheel = [[] for _ in range(self.slots)]
+            self._pending = 0
+            self._task = None
+            self._loop = loop
+        if self._task is None or self._task.done():
+            self._origin = loop.time()
+            self._tick = 0
+            self._task = loop.create_task(self._run())
+
+    async def sleep(self, delay: float) -> None:
+        """Suspend the caller for at least `delay` seconds"""
+        if delay <= 0:
+            await asyncio.sleep(0)
+            return
+
+        loop = asyncio.get_running_loop()
+        self._ensure_ticker(loop)
+        due = max(self._tick + 1, math.ceil((loop.time() + delay - self._origin) / self.resolution))
+        entry = (due, loop.create_future())
+        self._wheel[due % self.slots].append(entry)
+        self._pending += 1
+        try:
+            await entry[1]
+        except asyncio.CancelledError:
+            # Free the slot now (e.g. the client disconnected) rather than when the timer fires
+            try:
+                self._wheel[due % self.slots].remove(entry)
+                self._pending -= 1
+            except ValueError:
+                pass
+            raise
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            await asyncio.sleep(self.resolution)
+            now = int((loop.time() - self._origin) / self.resolution)
+            # Visit each slot passed since the last tick, at most one full turn
+            released = []
+            for tick in range(self._tick + 1, self._tick + 1 + min(now - self._tick, self.slots)):
+                index = tick % self.slots
+                slot = self._wheel[index]
+                if not slot:
+                    continue
+                remaining = []
+                for entry in slot:
+                    (released if entry[0] <= now else remaining).append(entry)
+                self._wheel[index] = remaining
+            # A tick that runs more than a turn late visits slots out of deadline order
+            released.sort(key=lambda entry: entry[0])
+            for _, waiter in released:
+                self._pending -= 1
+                if not waiter.done():
+                    waiter.set_result(None)
+            self._tick = max(self._tick, now)
+
+# Single pacing scheduler shared by all streams
+STREAM_SCHEDULER = TimerWheel(float(os.environ.get("QLM_SCHEDULER_RESOLUTION_MS", "5")) / 1000.0)
+
+class LatencyDistribution:
+    """
+    Delay distribution in seconds: a plain number (fixed) or a dict with
+    "distribution" set to fixed (value), normal (mean, stddev),
+    lognormal (median, sigma) or empirical (histogram of [delay, weight] pairs).
+    """
+
+    KINDS = ("fixed", "normal", "lognormal", "empirical")
+
+    def __init__(self, spec: Any = 0.0):
+        if not isinstance(spec, dict):
+            spec = {"distribution": "fixed", "value": spec}
+        self.spec = spec
+        self.kind = spec.get("distribution", "fixed")
+        if self.kind not in self.KINDS:
+            raise ValueError(f"Unknown latency distribution '{self.kind}'")
+
+        if self.kind == "fixed":
+            self.value = float(spec.get("value", 0.0))
+        elif self.kind == "normal":
+            self.mean = float(spec["mean"])
+            self.stddev = float(spec.get("stddev", 0.0))
+        elif self.kind == "lognormal":
+            self.mu = math.log(float(spec["median"]))
+            self.sigma = float(spec.get("sigma", 0.0))
+        else:
+            buckets = [(float(delay), weight) for delay, weight in spec["histogram"]]
+            self.histogram = AliasSampler(buckets)
+
+    def sample(self, rng) -> float:
+        if self.kind == "fixed":
+            return self.value
+        if self.kind == "normal":
+            return max(0.0, rng.gauss(self.mean, self.stddev))
+        if self.kind == "lognormal":
+            return rng.lognormvariate(self.mu, self.sigma)
+        return self.histogram.draw(rng=rng) or 0.0
+
+class LatencyProfile:
+    """
+    Simulated provider timing: time-to-first-token, inter-token delay and tail spikes.
+    A profile without inter_token paces streams at the plain tokens/sec rate.
+    non_streaming controls whether non-streaming responses wait for the simulated generation time.
+    """
+
+    def __init__(self, name: str, ttft: Any = 0.0, inter_token: Any = None,
+                 spike_probability: float = 0.0, spike_delay: Any = 0.0, non_streaming: bool = True,
+                 description: str = ""):
+        self.name = name
+        self.description = description
+        self.ttft = LatencyDistribution(ttft)
+        self.inter_token = LatencyDistribution(inter_token) if inter_token is not None else None
+        self.spike_probability = float(spike_probability)
+        self.spike_delay = LatencyDistribution(spike_delay)
+        self.non_streaming = non_streaming
+        self.ttft_scale = 1.0
+
+    @classmethod
+    def from_dict(cls, name: str, data: Dict[str, Any]) -> "LatencyProfile":
+        return cls(
+            name,
+            ttft=data.get("ttft", 0.0),
+            inter_token=data.get("inter_token"),
+            spike_probability=data.get("spike_probability", 0.0),
+            spike_delay=data.get("spike_delay", 0.0),
+            non_streaming=data.get("non_streaming", True),
+            description=data.get("description", ""),
+        )
+
+    def first_token_delay(self, rng) -> float:
+        return self.ttft.sample(rng) * self.ttft_scale
+
+    def with_ttft_scale(self, scale: float) -> "LatencyProfile":
+        """This profile with time-to-first-token multiplied by scale (prompt cache hits)"""
+        if scale == 1.0:
+            return self
+        profile = copy.copy(self)
+        profile.ttft_scale = self.ttft_scale * scale
+        return profile
+
+    def token_delay(self, tokens: int, rng, tokens_per_second: Optional[float] = None) -> float:
+        """
+        Delay for emitting `tokens` tokens. An explicit tokens_per_second overrides
+        the profile's inter-token distribution; spikes still apply.
+        """
+        if tokens_per_second is not None or self.inter_token is None:
+            rate = STREAM_TOKENS_PER_SECOND if tokens_per_second is None else tokens_per_second
+            delay = tokens / rate if rate > 0 else 0.0
+        else:
+            delay = 0.0
+            for _ in range(tokens):
+                delay += self.inter_token.sample(rng)
+
+        if self.spike_probability > 0:
+            for _ in range(tokens):
+                if rng.random() < self.spike_probability:
+                    delay += self.spike_delay.sample(rng)
+        return delay
+
+    def generation_time(self, text: str, rng) -> float:
+        """Simulated time to produce text without streaming (zero if non-streaming is skipped)"""
+        if not self.non_streaming:
+            return 0.0
+        return self.generation_time_for_tokens(count_tokens(text), rng)
+
+    def generation_time_for_tokens(self, tokens: int, rng) -> float:
+        """Total simulated time to produce `tokens` tokens without streaming"""
+        if not self.non_streaming:
+            return 0.0
+        return self.first_token_delay(rng) + self.token_delay(tokens, rng)
+
+# Built-in latency profiles (seconds); add more with QLM_LATENCY_PROFILES_FILE
+LATENCY_PROFILES = {
+    "classic": LatencyProfile(
+        "classic", non_streaming=False,
+        description="Original QLM timing: instant responses, streams paced at the tokens/sec rate"
+    ),
+    "instant": LatencyProfile("instant", inter_token=0.0, description="No delays at all"),
+    "fast": LatencyProfile(
+        "fast",
+        ttft={"distribution": "normal", "mean": 0.25, "stddev": 0.05},
+        inter_token={"distribution": "lognormal", "median": 0.012, "sigma": 0.3},
+        spike_probability=0.001, spike_delay=0.5,
+        description="Small hosted model on a quiet day"
+    ),
+    "standard": LatencyProfile(
+        "standard",
+        ttft={"distribution": "lognormal", "median": 0.6, "sigma": 0.4},
+        inter_token={"distribution": "lognormal", "median": 0.025, "sigma": 0.4},
+        spike_probability=0.002,
+        spike_delay={"distribution": "lognormal", "median": 1.0, "sigma": 0.5},
+        description="Typical large hosted model"
+    ),
+    "slow": LatencyProfile(
+        "slow",
+        ttft={"distribution": "lognormal", "median": 2.0, "sigma": 0.5},
+        inter_token={"distribution": "lognormal", "median": 0.06, "sigma": 0.5},
+        spike_probability=0.01,
+        spike_delay={"distribution": "lognormal", "median": 3.0, "sigma": 0.5},
+        description="Overloaded provider or large reasoning model"
+    ),
+    "flaky": LatencyProfile(
+        "flaky",
+        ttft={"distribution": "empirical",
+              "histogram": [[0.2, 70], [1.0, 20], [5.0, 9], [15.0, 1]]},
+        inter_token={"distribution": "empirical", "histogram": [[0.01, 90], [0.05, 9], [0.5, 1]]},
+        spike_probability=0.02, spike_delay=5.0,
+        description="Heavy-tailed first token and frequent stalls"
+    ),
+}
+
+def load_latency_profiles(path: Optional[str]) -> Dict[str, LatencyProfile]:
+    """Load extra latency profiles from a JSON file mapping profile name to settings"""
+    if not path:
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return {name: LatencyProfile.from_dict(name, spec) for name, spec in data.items()}
+
+LATENCY_PROFILES.update(load_latency_profiles(os.environ.get("QLM_LATENCY_PROFILES_FILE")))
+
+# Latency profile per model, e.g. QLM_MODEL_LATENCY_PROFILES="quack-model=fast,reasoning-duck=slow"
+MODEL_LATENCY_PROFILES = {"quack-model": "classic", "reasoning-duck": "classic"}
+for _entry in filter(None, os.environ.get("QLM_MODEL_LATENCY_PROFILES", "").split(",")):
+    _model, _, _profile = _entry.partition("=")
+    MODEL_LATENCY_PROFILES[_model.strip()] = _profile.strip()
+
+def resolve_latency_profile(model: str, requested: Optional[str] = None) -> LatencyProfile:
+    """
+    Pick the latency profile for a request: the X-QLM-Latency-Profile header wins,
+    then the model's configured profile, then classic. Raises 400 for unknown names.
+    """
+    name = requested or MODEL_LATENCY_PROFILES.get(model, "classic")
+    profile = LATENCY_PROFILES.get(name)
+    if profile is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown latency profile '{name}'. Use one of: {', '.join(LATENCY_PROFILES)}"
+        )
+    return profile
+
+def latency_rng(seed: Any = None):
+    """Per-request RNG for latency sampling; reproducible when the request sets a seed"""
+    seed = effective_seed(seed)
+    return random.Random(seed) if seed is not None else request_rng()
+
+class SSEFrameEncoder:
+    """
+    Encodes chunk SSE frames for one stream.
+    The envelope (id, object, created, model) is rendered once into prefix and
+    suffix bytes, so a content chunk only needs its fragment escaped.
+    """
+
+    _MARKER = "\x00qlm-content\x00"
+
+    def __init__(self, completion_id: str, model: str, object_type: str = "chat.completion.chunk",
+                 created: Optional[int] = None):
+        self.envelope = {
+            "id": completion_id,
+            "object": object_type,
+            "created": int(time.time()) if created is None else created,
+            "model": model,
+        }
+        rendered = json.dumps({**self.envelope, "choices": [self.content_choice(self._MARKER)]})
+        prefix, suffix = rendered.split(json.dumps(self._MARKER))
+        self._prefix = b"data: " + prefix.encode("utf-8")
+        self._suffix = suffix.encode("utf-8") + b"\n\n"
+
+    def content(self, fragment: str) -> bytes:
+        """Frame carrying a delta.content fragment"""
+        return self._prefix + encode_json_string(fragment).encode("ascii") + self._suffix
+
+    def frame(self, choice: Dict[str, Any], **extra: Any) -> bytes:
+        """Fully serialized frame for the less frequent role/final chunks"""
+        payload = json.dumps({**self.envelope, "choices": [choice], **extra})
+        return b"data: " + payload.encode("utf-8") + b"\n\n"
+
+    @staticmethod
+    def content_choice(text: str) -> Dict[str, Any]:
+        return {"index": 0, "delta": {"content": text}, "finish_reason": None}
+
+    def opening(self) -> Optional[bytes]:
+        """Frame sent before any content (the assistant role)"""
+        delta = {"role": "assistant", "content": ""}
+        return self.frame({"index": 0, "delta": delta, "finish_reason": None})
+
+    def closing(self, finish_reason: str, usage: Optional[Dict[str, Any]] = None) -> bytes:
+        """Final frame with the finish reason, and usage when requested"""
+        choice = {"index": 0, "delta": {}, "finish_reason": finish_reason}
+        return self.frame(choice) if usage is None else self.frame(choice, usage=usage)
+
+class TextCompletionFrameEncoder(SSEFrameEncoder):
+    """Frames for legacy text_completion streams, whose choices carry text instead of a delta"""
+
+    def __init__(self, completion_id: str, model: str, created: Optional[int] = None):
+        super().__init__(completion_id, model, "text_completion", created)
+
+    @staticmethod
+    def content_choice(text: str) -> Dict[str, Any]:
+        return {"text": text, "index": 0, "logprobs": None, "finish_reason": None}
+
+    def opening(self) -> Optional[bytes]:
+        return None
+
+    def closing(self, finish_reason: str, usage: Optional[Dict[str, Any]] = None) -> bytes:
+        choice = {"text": "", "index": 0, "logprobs": None, "finish_reason": finish_reason}
+        return self.frame(choice) if usage is None else self.frame(choice, usage=usage)
+
+# C-accelerated JSON string escaping (same output as json.dumps for a str)
+encode_json_string = json.encoder.encode_basestring_ascii
+
+async def metered_stream(frames):
+    """
+    Wrap an SSE generator to record active streams, time to first byte, bytes and duration.
+    Streams closed before their last frame (client disconnects) are counted as aborted.
+    """
+    start = time.perf_counter()
+    first = True
+    ACTIVE_STREAMS.inc()
+    try:
+        async for data in frames:
+            if first:
+                STREAM_TTFB.observe(time.perf_counter() - start)
+                first = False
+            STREAM_BYTES.inc(len(data))
+            yield data
+    except (asyncio.CancelledError, GeneratorExit):
+        STREAMS_ABORTED.labels("disconnect").inc()
+        raise
+    except Exception:
+        STREAMS_ABORTED.labels("error").inc()
+        raise
+    finally:
+        ACTIVE_STREAMS.dec()
+        STREAM_DURATION.observe(time.perf_counter() - start)
+        await frames.aclose()
+
+class SSEStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that always closes its generator when the response ends.
+    Starlette cancels the send loop as soon as the client disconnects (an ASGI
+    http.disconnect event); closing here stops generation and frees the stream's
+    scheduler slot right away, even if it was suspended between frames.
+    """
+
+    def __init__(self, content, **kwargs):
+        kwargs.setdefault("media_type", "text/event-stream")
+        super().__init__(content, **kwargs)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
 
 def validate_api_key(authorization: str = Header(None)) -> bool:
     """
@@ -199,123 +1565,457 @@ def validate_api_key(authorization: str = Header(None)) -> bool:
     # Duck-themed API keys: any key starting with "sk-v1-42"
     return api_key.startswith("sk-v1-42")
 
-def select_duck_reasoning(effort: str = "medium") -> str:
-    """
-    Select a duck reasoning message based on effort level.
-    """
-    # Adjust reasoning depth based on effort level
-    if effort == "low":
-        # Quick, simple reasoning
-        return secrets.choice([
-            "🦆💭 *quick quack analysis...*",
-            "🦆⚡ *fast duck thought...*",
-            "🦆👀 *glancing at the pond...*"
-        ])
-    elif effort == "high":
-        # Deep, elaborate reasoning
-        return secrets.choice([
-            "🦆🔬 *conducting extensive aquatic research across multiple ponds...*",
-            "🦆📚 *consulting the ancient duck wisdom archives...*",
-            "🦆🧩 *meticulously assembling complex quack patterns...*",
-            "🦆🌟 *accessing the deepest wells of duck consciousness...*"
-        ])
-    else:  # medium (default)
-        return secrets.choice(DUCK_REASONING_MESSAGES)
-
-def validate_response_integrity(user_input: str) -> Optional[str]:
-    """
-    Validate response integrity by checking input content.
-    Performs content validation for enhanced response patterns.
-    """
-    # Decode validation patterns
-    pattern_a = base64.b64decode("cmljaw==").decode('utf-8')  # Validation pattern A
-    pattern_b = base64.b64decode("cm9sbA==").decode('utf-8')  # Validation pattern B
-    
-    # Check if input contains both validation patterns (case-insensitive)
-    input_lower = user_input.lower()
-    if pattern_a in input_lower and pattern_b in input_lower:
-        return ENHANCED_RESPONSE
+def api_key_of(authorization: str) -> str:
+    """The API key from an Authorization header, with or without the Bearer prefix"""
+    return authorization[7:] if authorization.startswith("Bearer ") else authorization
 
-    return None
+def format_reset(seconds: float) -> str:
+    """OpenAI-style reset duration, e.g. 120ms, 1.5s or 6m0s"""
+    if seconds < 1:
+        return f"{int(seconds * 1000)}ms"
+    minutes, seconds = divmod(seconds, 60)
+    text = f"{seconds:.3f}".rstrip("0").rstrip(".") + "s"
+    return f"{int(minutes)}m{text}" if minutes else text
+
+class RateLimitStatus:
+    """Outcome of a rate limit check, rendered as x-ratelimit-* headers"""
+
+    __slots__ = ("limits", "remaining", "resets", "retry_after")
+
+    def __init__(self, limits: Dict[str, float], remaining: Dict[str, float],
+                 resets: Dict[str, float], retry_after: float = 0.0):
+        self.limits = limits
+        self.remaining = remaining
+        self.resets = resets
+        self.retry_after = retry_after
+
+    def headers(self) -> Dict[str, str]:
+        headers = {}
+        for kind, limit in self.limits.items():
+            headers[f"x-ratelimit-limit-{kind}"] = str(int(limit))
+            headers[f"x-ratelimit-remaining-{kind}"] = str(max(0, int(self.remaining[kind])))
+            headers[f"x-ratelimit-reset-{kind}"] = format_reset(self.resets[kind])
+        if self.retry_after:
+            headers["retry-after"] = str(math.ceil(self.retry_after))
+        return headers
+
+class RateLimiter:
+    """
+    Per-key requests-per-minute and tokens-per-minute token buckets.
+    Buckets live in a fixed-size open-addressing table of flat slots, so a check is
+    O(1): a key probes a short window of slots. A bucket left idle long enough to
+    refill is the same as a new one, so its slot is reused (idle-key eviction);
+    when a window is full of active keys the least recently used one is evicted.
+    With multiple workers the table moves to shared memory behind a process lock.
+    """
+
+    PROBES = 8
+    # An empty bucket is full again after a minute, so older slots can be reused
+    IDLE_SECONDS = 60.0
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 max_keys: int = 10000):
+        self.limits = {}
+        if requests_per_minute > 0:
+            self.limits["requests"] = float(requests_per_minute)
+        if tokens_per_minute > 0:
+            self.limits["tokens"] = float(tokens_per_minute)
+        self.capacity = 1 << max(4, (2 * max(1, max_keys) - 1).bit_length())
+        self.keys = memoryview(bytearray(8 * self.capacity)).cast("Q")
+        # Per slot: [requests level, tokens level, last update (monotonic seconds)]
+        self.state = memoryview(bytearray(24 * self.capacity)).cast("d")
+        self.lock = contextlib.nullcontext()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.limits)
+
+    def share(self) -> None:
+        """Move the bucket table into shared memory (call before fork)"""
+        import multiprocessing
+
+        memory = memoryview(mmap.mmap(-1, 32 * self.capacity))
+        keys = memory[:8 * self.capacity].cast("Q")
+        state = memory[8 * self.capacity:].cast("d")
+        keys[:] = self.keys
+        state[:] = self.state
+        self.keys, self.state = keys, state
+        self.lock = multiprocessing.Lock()
+
+    @staticmethod
+    def key_hash(key: str) -> int:
+        # 0 marks an empty slot
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") or 1
+
+    def _slot(self, key_hash: int, now: float) -> int:
+        """Find the key's slot, claiming an empty, idle or least recently used one"""
+        start = key_hash & (self.capacity - 1)
+        reusable = None
+        oldest = None
+        for probe in range(self.PROBES):
+            slot = (start + probe) & (self.capacity - 1)
+            stored = self.keys[slot]
+            if stored == key_hash:
+                return slot
+            updated = self.state[slot * 3 + 2]
+            if reusable is None and (stored == 0 or now - updated >= self.IDLE_SECONDS):
+                reusable = slot
+            if oldest is None or updated < self.state[oldest * 3 + 2]:
+                oldest = slot
+        slot = reusable if reusable is not None else oldest
+        self.keys[slot] = key_hash
+        self.state[slot * 3] = self.limits.get("requests", 0.0)
+        self.state[slot * 3 + 1] = self.limits.get("tokens", 0.0)
+        self.state[slot * 3 + 2] = now
+        return slot
+
+    def _refill(self, slot: int, now: float) -> None:
+        elapsed = now - self.state[slot * 3 + 2]
+        for index, kind in enumerate(("requests", "tokens")):
+            limit = self.limits.get(kind)
+            if limit:
+                level = self.state[slot * 3 + index]
+                self.state[slot * 3 + index] = min(limit, level + elapsed * limit / 60.0)
+        self.state[slot * 3 + 2] = now
+
+    def acquire(self, key: str, tokens: int = 0) -> Optional[RateLimitStatus]:
+        """
+        Take one request and `tokens` tokens from the key's buckets.
+        Returns None when limiting is disabled; a status with retry_after > 0 means throttled.
+        """
+        if not self.limits:
+            return None
+        costs = {"requests": 1.0, "tokens": float(tokens)}
+        now = time.monotonic()
+        with self.lock:
+            slot = self._slot(self.key_hash(key), now)
+            self._refill(slot, now)
+            levels = {"requests": self.state[slot * 3], "tokens": self.state[slot * 3 + 1]}
+
+            retry_after = 0.0
+            for kind, limit in self.limits.items():
+                shortfall = costs[kind] - levels[kind]
+                if shortfall > 0:
+                    retry_after = max(retry_after, shortfall * 60.0 / limit)
+            if not retry_after:
+                for index, kind in enumerate(("requests", "tokens")):
+                    if kind in self.limits:
+                        levels[kind] -= costs[kind]
+                        self.state[slot * 3 + index] = levels[kind]
+
+        resets = {kind: (limit - levels[kind]) * 60.0 / limit
+                  for kind, limit in self.limits.items()}
+        return RateLimitStatus(self.limits, levels, resets, retry_after)
+
+    def refund(self, key: str, tokens: int = 0) -> None:
+        """Give back the request and tokens taken by acquire, for a request that was then shed"""
+        if not self.limits:
+            return
+        now = time.monotonic()
+        with self.lock:
+            slot = self._slot(self.key_hash(key), now)
+            self._refill(slot, now)
+            for index, (kind, cost) in enumerate((("requests", 1.0), ("tokens", float(tokens)))):
+                limit = self.limits.get(kind)
+                if limit:
+                    self.state[slot * 3 + index] = min(limit, self.state[slot * 3 + index] + cost)
+
+    def charge(self, key: str, tokens: int) -> None:
+        """Deduct tokens known only after the response (the bucket may go negative)"""
+        if "tokens" not in self.limits or not tokens:
+            return
+        now = time.monotonic()
+        with self.lock:
+            slot = self._slot(self.key_hash(key), now)
+            self._refill(slot, now)
+            self.state[slot * 3 + 1] -= tokens
+
+RATE_LIMITER = RateLimiter(
+    requests_per_minute=float(os.environ.get("QLM_RATE_LIMIT_RPM", "0")),
+    tokens_per_minute=float(os.environ.get("QLM_RATE_LIMIT_TPM", "0")),
+    max_keys=int(os.environ.get("QLM_RATE_LIMIT_MAX_KEYS", "10000")),
+)
+
+def enforce_rate_limit(authorization: str, tokens: int) -> Dict[str, str]:
+    """
+    Apply the per-key limits to a request costing `tokens` prompt (and reserved
+    completion) tokens. Raises 429 when throttled; returns the x-ratelimit headers.
+    """
+    status = RATE_LIMITER.acquire(api_key_of(authorization), tokens)
+    if status is None:
+        return {}
+    if status.retry_after:
+        token_limit = RATE_LIMITER.limits.get("tokens")
+        if token_limit is not None and tokens > token_limit:
+            detail = (f"Request too large: {tokens} tokens exceeds the limit of "
+                      f"{int(token_limit)} tokens per minute")
+        else:
+            detail = ("Rate limit reached for this API key. "
+                      f"Please try again in {format_reset(status.retry_after)}.")
+        raise HTTPException(status_code=429, detail=detail, headers=status.headers())
+    return status.headers()
+
+def settle_rate_limit(authorization: str, max_tokens: Optional[int], usage: Dict[str, Any]) -> None:
+    """Charge completion tokens that were not reserved up front through max_tokens"""
+    if max_tokens is None:
+        RATE_LIMITER.charge(api_key_of(authorization), usage["completion_tokens"])
+
+def account_usage(authorization: str, max_tokens: Optional[int], usage: Dict[str, Any]) -> None:
+    """Record a finished response's usage in the served totals and the key's rate limit"""
+    record_usage(usage)
+    settle_rate_limit(authorization, max_tokens, usage)
+
+def select_duck_reasoning(effort: str = "medium", rng=None) -> str:
+    """
+    Select a duck reasoning message based on effort level (unknown levels use medium).
+    """
+    rng = rng or request_rng()
+    reasoning = CATALOG.reasoning
+    return rng.choice(reasoning.get(effort) or reasoning["medium"])
 
-def check_enhanced_responses(user_input: str) -> Optional[str]:
+# Trigger rules: canned responses for prompts containing keyword sets
+
+class TriggerRule:
+    """A canned response for prompts containing every one of its keywords (case-insensitive)"""
+
+    def __init__(self, name: str, keywords: List[str], response: str):
+        self.name = name
+        self.keywords = tuple(sorted({keyword.lower() for keyword in keywords}))
+        self.response = response
+        if not self.keywords or not all(self.keywords):
+            raise ValueError(f"Trigger rule '{name}' needs at least one non-empty keyword")
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "TriggerRule":
+        return cls(data["name"], data["keywords"], data["response"])
+
+def _trie_pattern(words: List[str]) -> str:
+    """Regex source matching any of words, shaped as a trie so shared prefixes are tried once"""
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: Dict[str, Any]) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # Greedy optional: the longest keyword at a position wins
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+class TriggerEngine:
+    """
+    Trigger rules compiled once into a single scanner: every rule's keywords become
+    one trie-shaped regex over lowercase text, so a prompt is scanned in one pass
+    however many rules there are. The prompt is lowercased in bounded windows
+    rather than copied whole; cost is linear in its length. The first rule (in
+    order) whose keywords all occur wins.
+    """
+
+    WINDOW = 64 * 1024
+
+    def __init__(self, rules: List[TriggerRule]):
+        self.rules = list(rules)
+        keywords = sorted({keyword for rule in self.rules for keyword in rule.keywords})
+        ids = {keyword: index for index, keyword in enumerate(keywords)}
+        # A match also implies the keywords that are prefixes of it (same start, shorter)
+        self._implied = {
+            keyword: frozenset(ids[prefix] for prefix in keywords if keyword.startswith(prefix))
+            for keyword in keywords
+        }
+        self._rule_ids = [frozenset(ids[keyword] for keyword in rule.keywords)
+                          for rule in self.rules]
+        self._keyword_count = len(keywords)
+        self._overlap = max(map(len, keywords), default=1) - 1
+        self._pattern = re.compile(_trie_pattern(keywords)) if keywords else None
+
+    def match(self, text: str) -> Optional[TriggerRule]:
+        """The first rule whose keywords all occur in text (case-insensitive), or None"""
+        if self._pattern is None or not text:
+            return None
+        found = set()
+        search = self._pattern.search
+        for start in range(0, len(text), self.WINDOW):
+            # Windows overlap by the longest keyword, so no match is split between two
+            window = text[start:start + self.WINDOW + self._overlap].lower()
+            match = search(window)
+            while match is not None:
+                found.update(self._implied[match.group()])
+                if len(found) == self._keyword_count:
+                    break
+                # Resume one character on, so overlapping keywords are found too
+                match = search(window, match.start() + 1)
+            if len(found) == self._keyword_count:
+                break
+        for rule, rule_ids in zip(self.rules, self._rule_ids):
+            if rule_ids <= found:
+                return rule
+        return None
+
+def load_trigger_rules(path: Optional[str]) -> List[TriggerRule]:
+    """Load extra trigger rules from a JSON file: a list of {name, keywords, response}"""
+    if not path:
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return [TriggerRule.from_dict(rule) for rule in data]
+
+# Built-in rules first (keywords encoded like the responses); add more with QLM_TRIGGERS_FILE
+TRIGGERS = TriggerEngine([
+    TriggerRule(
+        "enhanced",
+        [base64.b64decode("cmljaw==").decode("utf-8"),
+         base64.b64decode("cm9sbA==").decode("utf-8")],
+        ENHANCED_RESPONSE,
+    ),
+    *load_trigger_rules(os.environ.get("QLM_TRIGGERS_FILE")),
+])
+
+def check_enhanced_responses(user_input: str, rng=None) -> Optional[str]:
     """
     Check for enhanced response patterns in order of validation priority.
     Returns enhanced response if validation criteria are met, or None otherwise.
     """
-    # Check response integrity validation first (deterministic)
-    enhanced = validate_response_integrity(user_input)
-    if enhanced:
-        return enhanced
+    # Trigger rules first (deterministic)
+    rule = TRIGGERS.match(user_input)
+    if rule is not None:
+        return rule.response
 
     # Check random enhanced response (0.001% chance)
-    rand_value = secrets.randbelow(100000) / 100000.0
+    rand_value = (rng or request_rng()).randrange(100000) / 100000.0
     if rand_value <= 0.001:
         return EASTER_EGG
 
     return None
 
-def select_duck_sound() -> str:
+def select_duck_sound(session: Optional[DuckSession] = None, rng=None) -> str:
     """
     Select a duck sound based on weighted probabilities.
-    Uses cryptographically secure random for maximum randomness.
-    Prevents the same sound appearing twice in a row.
+    Uses the precomputed alias table, so each draw is O(1) regardless of catalog size.
+    Prevents the same sound appearing twice in a row for the given session.
     """
-    global LAST_RESPONSE
-    
-    max_attempts = 10  # Prevent infinite loop
+    session = session or DEFAULT_SESSION
 
-    for attempt in range(max_attempts):
-        # Weighted random selection
-        rand_value = secrets.randbelow(100000) / 100000.0 * TOTAL_WEIGHT
-        current_weight = 0.0
-        
-        for sound, weight in DUCK_SOUNDS:
-            current_weight += weight
-            if rand_value <= current_weight:
-                # Only reject if it's the same as the LAST response
-                if sound != LAST_RESPONSE:
-                    LAST_RESPONSE = sound
-                    return sound
-                # Try again if it matches the last one
-                break
+    sound = CATALOG.sound_sampler.draw(exclude=session.last_response, rng=rng)
 
-    # Fallback: return any sound different from last
-    for sound, _ in DUCK_SOUNDS:
-        if sound != LAST_RESPONSE:
-            LAST_RESPONSE = sound
-            return sound
-    
-    # Ultimate fallback (should never happen unless only 1 sound exists)
-    LAST_RESPONSE = "quack"
-    return "quack"
+    # Ultimate fallback (should never happen unless the catalog is empty)
+    if sound is None:
+        sound = "quack"
 
-def select_duck_thinking() -> str:
+    session.last_response = sound
+    return sound
+
+def select_duck_thinking(session: Optional[DuckSession] = None, rng=None) -> str:
     """
     Select a random duck thinking message.
-    Prevents the same thought appearing twice in a row.
+    Prevents the same thought appearing twice in a row for the given session.
     """
-    global LAST_THOUGHT
-    
-    max_attempts = 10  # Prevent infinite loop
-    
-    for attempt in range(max_attempts):
-        thought = secrets.choice(DUCK_THINKING_MESSAGES)
-        
-        # Only accept if different from last thought
-        if thought != LAST_THOUGHT:
-            LAST_THOUGHT = thought
-            return thought
-    
-    # Fallback: return any thought different from last
-    for thought in DUCK_THINKING_MESSAGES:
-        if thought != LAST_THOUGHT:
-            LAST_THOUGHT = thought
-            return thought
-    
+    session = session or DEFAULT_SESSION
+
+    thought = CATALOG.thinking_sampler.draw(exclude=session.last_thought, rng=rng)
+
     # Ultimate fallback (should never happen)
-    LAST_THOUGHT = "🦆💭 *thinking...*"
-    return LAST_THOUGHT
+    if thought is None:
+        thought = "🦆💭 *thinking...*"
+
+    session.last_thought = thought
+    return thought
+
+# Default completion budget when fill is requested without max_tokens
+DEFAULT_MAX_TOKENS = 100
+
+# Share of long-form output pieces that are thinking lines instead of sounds
+FILL_THINKING_RATE = 0.05
+
+def resolve_seed(body: Dict[str, Any]) -> Optional[int]:
+    """Read the OpenAI seed field, None when not set. Raises 400 unless it is an integer."""
+    seed = body.get("seed")
+    if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int)):
+        raise HTTPException(status_code=400, detail="seed must be an integer")
+    return seed
+
+def resolve_prompt(body: Dict[str, Any]) -> str:
+    """Read the legacy completions prompt, "" when not set. Raises 400 unless it is a string."""
+    prompt = body.get("prompt")
+    if prompt is None:
+        return ""
+    if not isinstance(prompt, str):
+        raise HTTPException(status_code=400, detail="prompt must be a string")
+    return prompt
+
+def resolve_max_tokens(body: Dict[str, Any]) -> Optional[int]:
+    """Read max_completion_tokens / max_tokens from a request, None when unset. 400 if invalid."""
+    max_tokens = body.get("max_completion_tokens", body.get("max_tokens"))
+    if max_tokens is None:
+        return None
+    if isinstance(max_tokens, bool) or not isinstance(max_tokens, int) or max_tokens < 1:
+        raise HTTPException(status_code=400, detail="max_tokens must be a positive integer")
+    return max_tokens
+
+def iter_duck_pieces(content: str, fill: bool = False, session: Optional[DuckSession] = None,
+                     rng=None):
+    """
+    Lazily yield response text: the content first, then (with fill) an endless
+    stream of weighted duck sounds, ASCII art and thinking lines.
+    Multi-line pieces and thinking lines get their own paragraph.
+    """
+    yield content
+    if not fill:
+        return
+
+    rng = rng or request_rng()
+    previous_block = "\n" in content
+    while True:
+        if rng.random() < FILL_THINKING_RATE:
+            piece = select_duck_thinking(session, rng)
+            block = True
+        else:
+            piece = select_duck_sound(session, rng)
+            block = "\n" in piece
+        yield ("\n\n" if block or previous_block else " ") + piece
+        previous_block = block
+
+class TokenLimiter:
+    """Caps a stream of text pieces at max_tokens simulated tokens, counting tokens as they pass"""
+
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self.tokens = 0
+        self.truncated = False
+
+    @property
+    def finish_reason(self) -> str:
+        return "length" if self.truncated else "stop"
+
+    def limit(self, pieces):
+        for piece in pieces:
+            remaining = self.max_tokens - self.tokens
+            if remaining <= 0:
+                self.truncated = True
+                return
+
+            count = count_tokens(piece)
+            if count <= remaining:
+                self.tokens += count
+                yield piece
+                continue
+
+            # Cut the piece at the last token boundary that fits
+            end = 0
+            for index, match in enumerate(TOKEN_PATTERN.finditer(piece)):
+                if index == remaining:
+                    break
+                end = match.end()
+            self.tokens += remaining
+            self.truncated = True
+            yield piece[:end]
+            return
 
 class DuckMessage:
     """Represents a duck sound message in OpenAI format"""
@@ -343,82 +2043,1187 @@ class DuckChoice:
             "finish_reason": self.finish_reason
         }
 
-def generate_duck_response(model: str, prompt: str = "", reasoning_effort: str = None, thinking: bool = False) -> Dict[str, Any]:
+# Request decoding
+
+MAX_BODY_BYTES = int(os.environ.get("QLM_MAX_BODY_BYTES", str(32 * 1024 * 1024)))
+
+# Content parts up to this size are decoded as is; larger non-text parts are skipped
+CONTENT_PART_INLINE_BYTES = 4096
+
+_JSON_WS = re.compile(rb"[ \t\n\r]*")
+_JSON_WS_STR = re.compile(r"[ \t\n\r]*")
+_JSON_WS_CHARS = (" ", "\t", "\n", "\r")
+_JSON_DECODER = json.JSONDecoder()
+
+# Messages containing this are scanned rather than decoded
+DATA_URI_MARKER = b";base64,"
+_JSON_STRUCTURE = re.compile(rb'["\[\]{}]')
+# A JSON literal or number, which must end at a delimiter
+_JSON_SCALAR = re.compile(
+    rb"(?:true|false|null|-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?)(?=[,\]}\s]|$)"
+)
+
+async def read_body(request: Request, limit: Optional[int] = None) -> bytes:
+    """The raw request body; bodies over limit bytes (0 = unlimited) get a 413 unbuffered"""
+    limit = MAX_BODY_BYTES if limit is None else limit
+    too_large = HTTPException(status_code=413,
+                              detail=f"Request body too large: the limit is {limit} bytes")
+    declared = request.headers.get("content-length", "")
+    if limit and declared.isdigit() and int(declared) > limit:
+        raise too_large
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if limit and size > limit:
+            raise too_large
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+class LazyChatRequest:
     """
-    Generate a duck-themed response in OpenAI API format.
-    Supports reasoning_effort parameter for OpenAI-compatible reasoning.
+    A chat request decoded on demand from the raw body. The top level is only
+    scanned for where each field starts and ends; fields are decoded when read.
+    Messages without a data URI are decoded by the C JSON scanner as they are
+    passed; a message holding one (a base64 image part) is only scanned, at
+    memchr speed, so its payload is never materialized as Python objects.
+    Skipped values are scanned, not validated. Raises ValueError on malformed JSON.
+    """
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self._decoded: Dict[int, Any] = {}
+        # One pass over the body: field spans, and the span of every message
+        spans = self._object_spans(self._skip_ws(0), elements_of="messages")
+        self._fields, end, self._messages = spans
+        if self._skip_ws(end) != len(raw):
+            raise ValueError(f"Extra data at byte {end}")
+        self._values: Dict[str, Any] = {}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """A top-level field, decoded on first access. Raises 400 if its JSON is malformed."""
+        if key not in self._fields:
+            return default
+        if key not in self._values:
+            start, end = self._fields[key]
+            try:
+                self._values[key] = json.loads(self.raw[start:end])
+            except ValueError as e:
+                # Nested values are only scanned up front, so they can still be malformed here
+                raise HTTPException(status_code=400,
+                                    detail=f"Invalid JSON body: field '{key}': {e}")
+        return self._values[key]
+
+    @property
+    def message_count(self) -> int:
+        return len(self._messages)
+
+    def message_bytes(self, index: int) -> Optional[bytes]:
+        """The raw JSON of one message, or None if there is no such message"""
+        try:
+            start, end = self._messages[index]
+        except IndexError:
+            return None
+        return self.raw[start:end]
+
+    def conversation_bytes(self) -> Optional[bytes]:
+        """
+        The raw JSON of the messages up to and including the first user message,
+        which is the same on every turn of one conversation and differs between
+        conversations that share a system prompt. None if there is no user message.
+        """
+        for index in range(len(self._messages)):
+            message = self.message(index)
+            if isinstance(message, dict) and message.get("role") == "user":
+                return self.raw[self._messages[0][0]:self._messages[index][1]]
+        return None
+
+    def message_digest(self, index: int) -> bytes:
+        """16-byte digest of one message's raw JSON, hashed in place"""
+        start, end = self._messages[index]
+        return hashlib.blake2b(memoryview(self.raw)[start:end], digest_size=16).digest()
+
+    def message(self, index: int) -> Optional[Dict[str, Any]]:
+        """One message, large non-text content parts reduced to their type. 400 if malformed."""
+        try:
+            start, end = self._messages[index]
+        except IndexError:
+            return None
+        decoded = self._decoded.get(index % len(self._messages))
+        if decoded is not None:
+            return decoded
+        try:
+            return self._decode_message(start, end)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON body: message {index}: {e}")
+
+    def _decode_message(self, start: int, end: int) -> Any:
+        if self.raw[start:start + 1] != b"{":
+            return json.loads(self.raw[start:end])
+        message = {}
+        for key, (value_start, value_end) in self._object_spans(start)[0].items():
+            if key == "content" and self.raw[value_start:value_start + 1] == b"[":
+                parts = self._array_spans(value_start)[0]
+                message[key] = [self._content_part(*span) for span in parts]
+            else:
+                message[key] = json.loads(self.raw[value_start:value_end])
+        return message
+
+    def _content_part(self, start: int, end: int) -> Any:
+        if end - start <= CONTENT_PART_INLINE_BYTES or self.raw[start:start + 1] != b"{":
+            return json.loads(self.raw[start:end])
+        fields = self._object_spans(start)[0]
+        part_type = json.loads(self.raw[slice(*fields["type"])]) if "type" in fields else None
+        if part_type == "text":
+            return json.loads(self.raw[start:end])
+        # The payload (e.g. an image_url data URI) is never decoded
+        return {"type": part_type}
+
+    # Scanning
+
+    def _skip_ws(self, pos: int) -> int:
+        return _JSON_WS.match(self.raw, pos).end()
+
+    def _string_end(self, pos: int) -> int:
+        raw = self.raw
+        if raw[pos:pos + 1] != b'"':
+            raise ValueError(f"Expecting string at byte {pos}")
+        end = pos + 1
+        while True:
+            # bytes.find runs at memchr speed over long strings such as data URIs
+            end = raw.find(b'"', end)
+            if end < 0:
+                raise ValueError(f"Unterminated string at byte {pos}")
+            # A quote after an odd number of backslashes is escaped
+            backslashes = 0
+            while raw[end - 1 - backslashes] == 0x5C:
+                backslashes += 1
+            if backslashes % 2 == 0:
+                return end + 1
+            end += 1
+
+    def _skip_value(self, pos: int) -> int:
+        """End of the JSON value starting at pos"""
+        raw = self.raw
+        first = raw[pos:pos + 1]
+        if first == b'"':
+            return self._string_end(pos)
+        if first == b"{" or first == b"[":
+            depth = 0
+            while True:
+                match = _JSON_STRUCTURE.search(raw, pos)
+                if match is None:
+                    raise ValueError(f"Unterminated value at byte {pos}")
+                char = raw[match.start()]
+                if char == 0x22:  # '"'
+                    pos = self._string_end(match.start())
+                    continue
+                pos = match.end()
+                depth += 1 if char in b"[{" else -1
+                if depth == 0:
+                    return pos
+        match = _JSON_SCALAR.match(raw, pos)
+        if match is None:
+            raise ValueError(f"Expecting value at byte {pos}")
+        return match.end()
+
+    def _object_spans(self, pos: int, elements_of: Optional[str] = None) -> tuple:
+        """
+        ({key: (start, end)}, end, elements) for the object starting at pos, where
+        elements are the element spans of the array under key elements_of, if any
+        """
+        raw = self.raw
+        if raw[pos:pos + 1] != b"{":
+            raise ValueError(f"Expecting object at byte {pos}")
+        spans = {}
+        elements = []
+        pos = self._skip_ws(pos + 1)
+        if raw[pos:pos + 1] == b"}":
+            return spans, pos + 1, elements
+        while True:
+            key_end = self._string_end(pos)
+            key = json.loads(raw[pos:key_end])
+            pos = self._skip_ws(key_end)
+            if raw[pos:pos + 1] != b":":
+                raise ValueError(f"Expecting ':' at byte {pos}")
+            start = self._skip_ws(pos + 1)
+            if key == elements_of and raw[start:start + 1] == b"[":
+                elements, end = self._message_spans(start)
+            else:
+                end = self._skip_value(start)
+            spans[key] = (start, end)
+            pos = self._skip_ws(end)
+            separator = raw[pos:pos + 1]
+            if separator == b"}":
+                return spans, pos + 1, elements
+            if separator != b",":
+                raise ValueError(f"Expecting ',' or '}}' at byte {pos}")
+            pos = self._skip_ws(pos + 1)
+
+    def _message_spans(self, pos: int) -> tuple:
+        """
+        ([(start, end), ...], end) for the messages array starting at pos. Runs of
+        messages before the next data URI are decoded in C (and kept); only the
+        message holding the data URI goes through the span scanner.
+        """
+        raw = self.raw
+        spans = []
+        pos = self._skip_ws(pos + 1)
+        if raw[pos:pos + 1] == b"]":
+            return spans, pos + 1
+        while True:
+            heavy = raw.find(DATA_URI_MARKER, pos)
+            segment = raw[pos:heavy if heavy >= 0 else len(raw)].decode("utf-8", "surrogateescape")
+            ascii_only = segment.isascii()
+            # Segment character offsets map to body bytes as base + offset for ASCII,
+            # otherwise through a running count of encoded bytes
+            base, char_at, byte_at = pos, 0, pos
+            offset = 0
+            scan = _JSON_DECODER.scan_once
+            while True:
+                try:
+                    value, end = scan(segment, offset)
+                except (StopIteration, ValueError):
+                    break
+                if ascii_only:
+                    start_pos, end_pos = base + offset, base + end
+                else:
+                    byte_at += len(segment[char_at:offset].encode("utf-8", "surrogateescape"))
+                    start_pos = byte_at
+                    byte_at += len(segment[offset:end].encode("utf-8", "surrogateescape"))
+                    end_pos, char_at = byte_at, end
+                self._decoded[len(spans)] = value
+                spans.append((start_pos, end_pos))
+                offset = end
+                if segment[offset:offset + 1] in _JSON_WS_CHARS:
+                    offset = _JSON_WS_STR.match(segment, offset).end()
+                separator = segment[offset:offset + 1]
+                if separator == "]":
+                    return spans, end_pos + (offset - end) + 1
+                if separator != ",":
+                    raise ValueError(f"Expecting ',' or ']' at byte {end_pos + (offset - end)}")
+                offset += 1
+                if segment[offset:offset + 1] in _JSON_WS_CHARS:
+                    offset = _JSON_WS_STR.match(segment, offset).end()
+
+            # The next message runs into the data URI: scan it instead
+            if offset:
+                if ascii_only:
+                    pos = base + offset
+                else:
+                    pos = byte_at + len(segment[char_at:offset].encode("utf-8", "surrogateescape"))
+            end = self._skip_value(pos)
+            spans.append((pos, end))
+            pos = self._skip_ws(end)
+            separator = raw[pos:pos + 1]
+            if separator == b"]":
+                return spans, pos + 1
+            if separator != b",":
+                raise ValueError(f"Expecting ',' or ']' at byte {pos}")
+            pos = self._skip_ws(pos + 1)
+
+    def _array_spans(self, pos: int) -> tuple:
+        """([(start, end), ...], end) for the array starting at pos"""
+        raw = self.raw
+        spans = []
+        pos = self._skip_ws(pos + 1)
+        if raw[pos:pos + 1] == b"]":
+            return spans, pos + 1
+        while True:
+            end = self._skip_value(pos)
+            spans.append((pos, end))
+            pos = self._skip_ws(end)
+            separator = raw[pos:pos + 1]
+            if separator == b"]":
+                return spans, pos + 1
+            if separator != b",":
+                raise ValueError(f"Expecting ',' or ']' at byte {pos}")
+            pos = self._skip_ws(pos + 1)
+
+def message_prompt(message: Optional[Dict[str, Any]]) -> str:
+    """The prompt text of a message, if it is from the user"""
+    prompt = ""
+    if message and message.get("role") == "user":
+        content = message.get("content", "")
+
+        # Handle multimodal content (Roo sends content as list)
+        if isinstance(content, list):
+            # Extract text from multimodal content
+            text_parts = []
+            for part in content:
+                if isinstance(part, dict) and part.get("type") == "text":
+                    text = part.get("text")
+                    if isinstance(text, str):
+                        text_parts.append(text)
+            prompt = " ".join(text_parts)
+        elif isinstance(content, str):
+            # null or non-text content counts as an empty prompt
+            prompt = content
+    return prompt
+
+def extract_prompt(messages: List[Dict[str, Any]]) -> str:
+    """The prompt text: the last message, if it is from the user"""
+    return message_prompt(messages[-1]) if messages else ""
+
+# Token accounting
+
+# Chat format overhead, as OpenAI counts it: per message, per name, and the reply priming
+MESSAGE_OVERHEAD_TOKENS = 3
+NAME_TOKENS = 1
+REPLY_PRIMING_TOKENS = 3
+# Image parts: "low" detail, and anything else (a 1024x1024 image at high detail)
+LOW_DETAIL_IMAGE_TOKENS = 85
+IMAGE_TOKENS = 765
+
+def count_value_tokens(value: Any) -> int:
+    """Tokens in a message field: text, content parts, tool calls or any other JSON value"""
+    if isinstance(value, str):
+        return count_tokens(value)
+    if isinstance(value, list):
+        return sum(count_value_tokens(item) for item in value)
+    if isinstance(value, dict):
+        if value.get("type") in ("image_url", "input_image"):
+            image = value.get("image_url")
+            detail = image.get("detail") if isinstance(image, dict) else None
+            return LOW_DETAIL_IMAGE_TOKENS if detail == "low" else IMAGE_TOKENS
+        return sum(count_value_tokens(item) for key, item in value.items()
+                   if key not in ("type", "id"))
+    if value is None or isinstance(value, bool):
+        return 0
+    return count_tokens(str(value))
+
+def count_message_tokens(message: Any) -> int:
+    """Tokens of one chat message: role, content, name, tool calls, plus the format overhead"""
+    if not isinstance(message, dict):
+        return MESSAGE_OVERHEAD_TOKENS + count_value_tokens(message)
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for key, value in message.items():
+        tokens += count_value_tokens(value)
+        if key == "name":
+            tokens += NAME_TOKENS
+    return tokens
+
+def count_messages_tokens(messages: List[Any]) -> int:
+    """Prompt tokens of a whole conversation"""
+    return REPLY_PRIMING_TOKENS + sum(count_message_tokens(message) for message in messages)
+
+class MessageTokenCache:
+    """
+    LRU of message token counts keyed by a digest of each message's raw JSON.
+    Every turn of a conversation resends its history; only new messages are counted,
+    and each message is counted at most once per request.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.counts: "OrderedDict[bytes, int]" = OrderedDict()
+
+    def message_tokens(self, body: LazyChatRequest) -> List[tuple]:
+        """(digest, tokens) for every message in a chat request"""
+        blocks = []
+        for index in range(body.message_count):
+            key = body.message_digest(index)
+            count = self.counts.get(key)
+            if count is None:
+                count = count_message_tokens(body.message(index))
+                self.counts[key] = count
+                if len(self.counts) > self.max_entries:
+                    self.counts.popitem(last=False)
+            else:
+                self.counts.move_to_end(key)
+            blocks.append((key, count))
+        return blocks
+
+MESSAGE_TOKENS = MessageTokenCache(int(os.environ.get("QLM_TOKEN_CACHE_SIZE", "100000")))
+
+class PromptPrefixCache:
+    """
+    Simulated provider prompt caching over message blocks. A request's messages form a
+    hash chain seeded with the API key, so each prefix has one 16-byte hash covering
+    every message up to it; the cached prefix is the longest one seen within the TTL.
+    Like the provider, only prompts of at least min_tokens are cached, and
+    cached_tokens is reported in steps of increment. Entries expire after ttl seconds
+    without use and the least recently used go first beyond max_entries.
+    """
+
+    # Approximate memory per entry: the hash, its expiry and the ordered dict node
+    ENTRY_BYTES = 200
+
+    def __init__(self, ttl: float, max_entries: int, min_tokens: int = 1024, increment: int = 128):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.min_tokens = min_tokens
+        self.increment = increment
+        self._expiry: "OrderedDict[bytes, float]" = OrderedDict()
+
+    def cached_tokens(self, api_key: str, blocks: List[tuple]) -> int:
+        """cached_tokens for a prompt of (message digest, tokens) blocks; records its prefixes"""
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return 0
+        now = time.monotonic()
+        # Entries are ordered by last use and share one TTL, so the oldest expire first
+        while self._expiry and next(iter(self._expiry.values())) <= now:
+            self._expiry.popitem(last=False)
+
+        chain = hashlib.blake2b(api_key.encode("utf-8"), digest_size=16).digest()
+        expires = now + self.ttl
+        tokens = 0
+        cached = 0
+        for digest, count in blocks:
+            chain = hashlib.blake2b(chain + digest, digest_size=16).digest()
+            tokens += count
+            if chain in self._expiry:
+                cached = tokens
+                self._expiry.move_to_end(chain)
+            self._expiry[chain] = expires
+        while len(self._expiry) > self.max_entries:
+            self._expiry.popitem(last=False)
+
+        if cached < self.min_tokens:
+            return 0
+        return cached - cached % self.increment if self.increment > 1 else cached
+
+    def __len__(self) -> int:
+        return len(self._expiry)
+
+PREFIX_CACHE = PromptPrefixCache(
+    ttl=float(os.environ.get("QLM_PREFIX_CACHE_TTL", "300")),
+    max_entries=int(float(os.environ.get("QLM_PREFIX_CACHE_MB", "16")) * 1024 * 1024)
+    // PromptPrefixCache.ENTRY_BYTES,
+    min_tokens=int(os.environ.get("QLM_PREFIX_CACHE_MIN_TOKENS", "1024")),
+    increment=int(os.environ.get("QLM_PREFIX_CACHE_INCREMENT", "128")),
+)
+# Share of time-to-first-token saved for a fully cached prompt (0 leaves TTFT alone)
+PREFIX_CACHE_TTFT_DISCOUNT = float(os.environ.get("QLM_PREFIX_CACHE_TTFT_DISCOUNT", "0"))
+
+def build_duck_content(model: str, prompt: str = "", reasoning_effort: str = None,
+                       thinking: bool = False, session: Optional[DuckSession] = None,
+                       rng=None) -> tuple:
+    """
+    Build the (response_content, reasoning_content) pair for a chat response.
     Checks for enhanced responses first, then falls back to duck sounds.
     """
     # Check for enhanced responses first
-    enhanced_response = check_enhanced_responses(prompt)
+    enhanced_response = check_enhanced_responses(prompt, rng)
     if enhanced_response:
         response_content = enhanced_response
         # Add reasoning if this is a reasoning model or reasoning requested
         reasoning_content = None
     else:
         # Normal duck sound generation
-        response_content = select_duck_sound()
+        response_content = select_duck_sound(session, rng)
         reasoning_content = None
 
     # Add reasoning if requested or if model is reasoning-capable
     if reasoning_effort or "reasoning" in model.lower():
         if reasoning_content is None:  # Generate reasoning for normal responses
-            reasoning_content = select_duck_reasoning(reasoning_effort or "medium")
+            reasoning_content = select_duck_reasoning(reasoning_effort or "medium", rng)
         # Add reasoning to response
         response_content = f"{reasoning_content}\n\n{response_content}"
 
     # Add thinking message if legacy thinking parameter is used
     if thinking and reasoning_content is None:
-        thinking_message = select_duck_thinking()
+        thinking_message = select_duck_thinking(session, rng)
         response_content = f"{thinking_message}\n\n{response_content}"
 
+    return response_content, reasoning_content
+
+def build_duck_usage(prompt_tokens: int, completion_tokens: int,
+                     reasoning_content: Optional[str] = None, reasoning_model: bool = False,
+                     cached_tokens: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Build the usage block; reasoning models also report reasoning_tokens, and chat
+    (which simulates prompt caching) reports prompt_tokens_details.cached_tokens
+    """
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+    if cached_tokens is not None:
+        usage["prompt_tokens_details"] = {"cached_tokens": cached_tokens}
+    if reasoning_model:
+        usage["reasoning_tokens"] = count_tokens(reasoning_content)
+    return usage
+
+class DuckGeneration:
+    """
+    One duck response: the generation engine shared by chat and legacy completions,
+    streaming or not. The content is chosen up front; long-form fill and the
+    max_tokens cap are applied lazily as pieces are consumed. prompt_tokens
+    defaults to the prompt's own count; chat passes the whole conversation's,
+    and the cached_tokens of its simulated prompt cache.
+    """
+
+    def __init__(self, model: str, prompt: str = "", reasoning_effort: str = None,
+                 thinking: bool = False, session: Optional[DuckSession] = None,
+                 max_tokens: Optional[int] = None,
+                 fill: bool = False, rng=None, prompt_tokens: Optional[int] = None,
+                 cached_tokens: Optional[int] = None):
+        self.model = model
+        self.prompt = prompt
+        self.prompt_tokens = count_tokens(prompt) if prompt_tokens is None else prompt_tokens
+        self.cached_tokens = cached_tokens
+        self.reasoning_model = "reasoning" in model.lower()
+        self.content, self.reasoning_content = build_duck_content(
+            model, prompt, reasoning_effort, thinking, session, rng
+        )
+        self.fill = fill
+        self.session = session
+        self.rng = rng
+        self.limiter = None
+        if max_tokens is not None or fill:
+            limit = max_tokens if max_tokens is not None else DEFAULT_MAX_TOKENS
+            self.limiter = TokenLimiter(limit)
+
+    def pieces(self):
+        """Lazily yield the response text (consume once)"""
+        pieces = iter_duck_pieces(self.content, self.fill, self.session, self.rng)
+        return self.limiter.limit(pieces) if self.limiter else pieces
+
+    def text(self) -> str:
+        return "".join(self.pieces())
+
+    @property
+    def completion_tokens(self) -> int:
+        return self.limiter.tokens if self.limiter else count_tokens(self.content)
+
+    @property
+    def finish_reason(self) -> str:
+        return self.limiter.finish_reason if self.limiter else "stop"
+
+    def usage(self) -> Dict[str, Any]:
+        """Usage block; valid once the pieces have been consumed"""
+        return build_duck_usage(self.prompt_tokens, self.completion_tokens, self.reasoning_content,
+                                reasoning_model=self.reasoning_model,
+                                cached_tokens=self.cached_tokens)
+
+def generate_duck_response(model: str, prompt: str = "", reasoning_effort: str = None,
+                           thinking: bool = False, session: Optional[DuckSession] = None,
+                           max_tokens: Optional[int] = None,
+                           fill: bool = False, rng=None, prompt_tokens: Optional[int] = None,
+                           cached_tokens: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Generate a duck-themed response in OpenAI API format.
+    Supports reasoning_effort parameter for OpenAI-compatible reasoning.
+    Checks for enhanced responses first, then falls back to duck sounds.
+    Repeat avoidance is tracked on the given client session.
+    When max_tokens is set the content is capped (finish_reason "length"), and
+    fill keeps quacking until the cap is reached.
+    """
+    generation = DuckGeneration(model, prompt, reasoning_effort, thinking, session, max_tokens,
+                                fill, rng, prompt_tokens, cached_tokens)
+    response_content = generation.text()
+    reasoning_content = generation.reasoning_content
+    finish_reason = generation.finish_reason
+
     # Build response based on model type
-    if "reasoning" in model.lower():
+    if generation.reasoning_model:
+        reasoning = reasoning_content or select_duck_reasoning(reasoning_effort or "medium", rng)
         # Reasoning model response format
         response = {
-            "id": f"chatcmpl-{secrets.token_hex(16)}",
+            "id": new_completion_id(),
             "object": "chat.completion",
             "created": int(time.time()),
             "model": model,
             "choices": [
                 {
-                    "finish_reason": "stop",
+                    "finish_reason": finish_reason,
                     "index": 0,
                     "message": {
                         "content": response_content,
                         "role": "assistant"
                     },
-                    "reasoning": reasoning_content or select_duck_reasoning(reasoning_effort or "medium")
+                    "reasoning": reasoning
                 }
             ],
-            "usage": {
-                "prompt_tokens": len(prompt.split()) if prompt else 0,
-                "completion_tokens": len(response_content.split()),
-                "total_tokens": (len(prompt.split()) if prompt else 0) + len(response_content.split()),
-                "reasoning_tokens": len((reasoning_content or "").split()) if reasoning_content else 0
-            }
+            "usage": generation.usage()
         }
     else:
         # Standard response format
         response = {
-            "id": f"chatcmpl-{secrets.token_hex(16)}",
+            "id": new_completion_id(),
             "object": "chat.completion",
             "created": int(time.time()),
             "model": model,
             "choices": [
                 DuckChoice(
-                    DuckMessage(response_content)
+                    DuckMessage(response_content),
+                    finish_reason
                 ).to_dict()
             ],
-            "usage": {
-                "prompt_tokens": len(prompt.split()) if prompt else 0,
-                "completion_tokens": len(response_content.split()),
-                "total_tokens": (len(prompt.split()) if prompt else 0) + len(response_content.split())
-            }
+            "usage": generation.usage()
         }
 
     return response
 
+def generate_text_completion(generation: DuckGeneration) -> Dict[str, Any]:
+    """Legacy text_completion response for a generation"""
+    return {
+        "id": new_completion_id("cmpl"),
+        "object": "text_completion",
+        "created": int(time.time()),
+        "model": generation.model,
+        "choices": [
+            {
+                "text": generation.text(),
+                "index": 0,
+                "logprobs": None,
+                "finish_reason": generation.finish_reason
+            }
+        ],
+        "usage": generation.usage()
+    }
+
+async def stream_generation(generation: DuckGeneration, encoder: SSEFrameEncoder,
+                            latency: LatencyProfile, latency_random, chunking: str,
+                            chunk_size: int, tokens_per_second: Optional[float],
+                            include_usage: bool = False, on_usage=None):
+    """
+    Streaming engine: emit a generation as SSE frames after the simulated time to
+    first token, at the requested granularity and token rate. Frames whose combined
+    delay is too short to sleep for are coalesced into one write. Ends with the
+    finish frame (with usage if requested) and [DONE]; on_usage gets the usage block.
+    """
+    await STREAM_SCHEDULER.sleep(latency.first_token_delay(latency_random))
+
+    opening = encoder.opening()
+    if opening is not None:
+        STREAM_CHUNKS.inc()
+        yield opening
+
+    batch = []
+    batch_bytes = 0
+    pending_delay = 0.0
+    for piece in iter_stream_chunks(generation.pieces(), chunking, chunk_size):
+        frame = encoder.content(piece)
+        batch.append(frame)
+        batch_bytes += len(frame)
+        pending_delay += latency.token_delay(stream_chunk_tokens(piece, chunking), latency_random,
+                                             tokens_per_second)
+        if pending_delay >= STREAM_MIN_SLEEP or batch_bytes >= STREAM_MAX_WRITE_BYTES:
+            STREAM_CHUNKS.inc(len(batch))
+            yield b"".join(batch)
+            batch = []
+            batch_bytes = 0
+            if pending_delay:
+                await STREAM_SCHEDULER.sleep(pending_delay)
+            pending_delay = 0.0
+
+    usage = generation.usage()
+    if on_usage is not None:
+        on_usage(usage)
+    batch.append(encoder.closing(generation.finish_reason, usage if include_usage else None))
+    STREAM_CHUNKS.inc(len(batch))
+    batch.append(SSE_DONE)
+    yield b"".join(batch)
+
+def streaming_response(generation: DuckGeneration, encoder: SSEFrameEncoder,
+                       latency: LatencyProfile, latency_random,
+                       stream_options: Optional[Dict[str, Any]], on_usage=None,
+                       headers: Optional[Dict[str, str]] = None) -> "SSEStreamingResponse":
+    """SSE response streaming a generation with the request's stream_options"""
+    chunking, chunk_size, tokens_per_second = resolve_stream_options(stream_options)
+    include_usage = bool((stream_options or {}).get("include_usage", False))
+    frames = stream_generation(generation, encoder, latency, latency_random, chunking, chunk_size,
+                               tokens_per_second, include_usage, on_usage)
+    return SSEStreamingResponse(
+        metered_stream(frames),
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            **(headers or {}),
+        }
+    )
+
+class ResponseCache:
+    """
+    LRU cache of serialized response bodies, bounded by total bytes.
+    Entries are (body, usage): replays account usage and simulate generation time
+    from the stored usage block without parsing the body.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+
+    def get(self, key: Any) -> Optional[tuple]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: Any, body: bytes, usage: Dict[str, Any]) -> None:
+        if len(body) > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous[0])
+        self._entries[key] = (body, usage)
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+# Serialized responses for seeded requests (QLM_RESPONSE_CACHE_MB=0 disables)
+RESPONSE_CACHE_MB = float(os.environ.get("QLM_RESPONSE_CACHE_MB", "64"))
+RESPONSE_CACHE = ResponseCache(int(RESPONSE_CACHE_MB * 1024 * 1024))
+
+def replay_body(body: bytes) -> bytes:
+    """
+    A cached chat.completion body with a fresh id and created time, so replays are
+    distinguishable like any other response; everything after them is reused as is.
+    """
+    tail = body.index(b',"model":')
+    head = json.dumps({"id": new_completion_id(), "object": "chat.completion",
+                       "created": int(time.time())}, separators=(",", ":"))
+    return head[:-1].encode("utf-8") + memoryview(body)[tail:]
+
+def prompt_digest(prompt: str) -> bytes:
+    """Fixed-size digest of a prompt for seeds and cache keys"""
+    return hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).digest()
+
+# Embeddings
+
+EMBEDDING_MODEL = "quack-embedding"
+EMBEDDING_DIMENSIONS = 1536
+EMBEDDING_MAX_DIMENSIONS = 3072
+EMBEDDING_HASH_BITS = 128
+
+_embedding_basis = None
+
+def embedding_basis() -> np.ndarray:
+    """
+    Fixed (hash bits x max dimensions) projection matrix with entries in [-1, 1),
+    built once from a splitmix64 counter so vectors never change between releases.
+    """
+    global _embedding_basis
+    if _embedding_basis is None:
+        with np.errstate(over="ignore"):
+            x = np.arange(EMBEDDING_HASH_BITS * EMBEDDING_MAX_DIMENSIONS, dtype=np.uint64)
+            x = x * np.uint64(0x9E3779B97F4A7C15) + np.uint64(0x51A7D0C4)
+            x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            x ^= x >> np.uint64(31)
+        uniform = (x >> np.uint64(40)).astype(np.float32) / np.float32(1 << 23) - np.float32(1.0)
+        _embedding_basis = uniform.reshape(EMBEDDING_HASH_BITS, EMBEDDING_MAX_DIMENSIONS)
+    return _embedding_basis
+
+def embed_texts(texts: List[str], dimensions: int = EMBEDDING_DIMENSIONS) -> np.ndarray:
+    """
+    Deterministic unit vectors, one row per text, in a single batched computation:
+    each text's 128-bit hash becomes a +/-1 vector that is projected through the
+    fixed basis. Equal texts give equal vectors; different texts are near-orthogonal,
+    and shorter `dimensions` are truncations of the full vector, renormalized.
+    """
+    digests = b"".join(prompt_digest(text) for text in texts)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(len(texts), -1), axis=1)
+    signs = bits.astype(np.float32) * np.float32(2.0) - np.float32(1.0)
+    vectors = signs @ embedding_basis()[:, :dimensions]
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype("<f4", copy=False)
+
+def embedding_inputs(value: Any) -> List[str]:
+    """Normalize the input parameter (string, strings, token array or token arrays) to texts"""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list) and value:
+        if all(isinstance(item, str) for item in value):
+            return value
+        if all(isinstance(item, int) for item in value):
+            return [" ".join(map(str, value))]
+        if all(isinstance(item, list) and all(isinstance(t, int) for t in item) for item in value):
+            return [" ".join(map(str, item)) for item in value]
+    raise HTTPException(
+        status_code=400,
+        detail="input must be a string, an array of strings or an array of token arrays"
+    )
+
+# Float embeddings are written with 8 decimals: within 5e-9 of the float32 value,
+# below float32 epsilon relative to the unit norm, so similarities are unchanged
+EMBEDDING_FLOAT_DECIMALS = 8
+
+# Responses with more values than this are built in a worker thread
+EMBEDDING_INLINE_VALUES = 64 * 1024
+
+# Little-endian 4-byte words for float formatting: separator, sign, integer digit and
+# point (index: integer digit + 2 if negative), and every group of 4 decimals
+_FLOAT_LEADS = np.frombuffer(b", 0., 1.,-0.,-1.", dtype="<u4")
+_FLOAT_DIGITS = np.frombuffer(
+    "".join(f"{i:04d}" for i in range(10000)).encode("ascii"), dtype="<u4"
+)
+
+def base64_embedding_rows(vectors: np.ndarray) -> List[str]:
+    """Rows packed straight from the array buffer as base64 little-endian float32"""
+    row_bytes = vectors.shape[1] * vectors.itemsize
+    if row_bytes % 3 == 0:
+        # Rows end on base64 group boundaries: encode once and slice
+        encoded = base64.b64encode(memoryview(vectors).cast("B")).decode("ascii")
+        width = row_bytes // 3 * 4
+        return [encoded[i * width:(i + 1) * width] for i in range(len(vectors))]
+    return [base64.b64encode(memoryview(row)).decode("ascii") for row in vectors]
+
+def float_embedding_rows(vectors: np.ndarray) -> List[memoryview]:
+    """
+    Rows as JSON arrays, formatted in bulk with numpy instead of float by float.
+    Every value is 12 bytes (",-0.01234567"), assembled from three table lookups,
+    so the whole matrix is formatted with a handful of array operations and the
+    rows are views into one buffer.
+    """
+    scale = 10 ** EMBEDDING_FLOAT_DECIMALS
+    scaled = (np.abs(vectors).astype(np.float64) * scale + 0.5).astype(np.uint32)
+    whole = scaled // np.uint32(10 ** 8)
+    fraction = scaled - whole * np.uint32(10 ** 8)
+    high = fraction // np.uint32(10 ** 4)
+    low = fraction - high * np.uint32(10 ** 4)
+    lead = whole + np.signbit(vectors).astype(np.uint32) * np.uint32(2)
+    words = np.stack(
+        [_FLOAT_LEADS.take(lead), _FLOAT_DIGITS.take(high), _FLOAT_DIGITS.take(low)], axis=-1
+    )
+    # One more word per row closes the array (padded with whitespace)
+    text = np.empty((len(vectors), words[0].size + 1), dtype="<u4")
+    text[:, :-1] = words.reshape(len(vectors), -1)
+    text[:, -1] = np.frombuffer(b"]   ", dtype="<u4")[0]
+    text = text.view(np.uint8)
+    text[:, 0] = ord("[")
+    return [row.data for row in text]
+
+def build_embedding_body(vectors: np.ndarray, encoding_format: str, model: str,
+                         usage: Dict[str, int]) -> bytes:
+    """Serialized embeddings response; float rows are spliced in already formatted"""
+    if encoding_format == "base64":
+        rows = [json.dumps(row).encode("ascii") for row in base64_embedding_rows(vectors)]
+    else:
+        rows = float_embedding_rows(vectors)
+    # Rows are joined into the body in a single copy
+    parts = [b'{"object":"list","data":[']
+    for index, row in enumerate(rows):
+        parts.append(b'{"object":"embedding","index":%d,"embedding":' % index if index == 0
+                     else b'},{"object":"embedding","index":%d,"embedding":' % index)
+        parts.append(row)
+    tail = json.dumps({"model": model, "usage": usage}, ensure_ascii=False)[1:]
+    parts.append(b"}" * bool(rows) + b"]," + tail.encode("utf-8"))
+    return b"".join(parts)
+
+# Batch API (OpenAI-compatible mock backed by a local directory)
+
+BATCH_ENDPOINTS = ("/v1/chat/completions", "/v1/completions")
+
+def batch_request_response(endpoint: str, body: Dict[str, Any],
+                           session: DuckSession) -> Dict[str, Any]:
+    """
+    Response body for one batch request line, generated directly (no HTTP, no simulated latency).
+    Seeded requests give the same output as the equivalent online request.
+    """
+    model = body.get("model", "quack-model")
+    if endpoint == "/v1/chat/completions":
+        messages = body.get("messages", [])
+        if not isinstance(messages, list) or not all(isinstance(m, dict) for m in messages):
+            raise HTTPException(status_code=400,
+                                detail="messages must be an array of message objects")
+        prompt = extract_prompt(messages)
+    else:
+        prompt = resolve_prompt(body)
+    max_tokens = resolve_max_tokens(body)
+    reasoning_effort = body.get("reasoning_effort", None)
+    quack_thinking = body.get("quack_thinking", False)
+    quack_fill = body.get("quack_fill", False)
+
+    seed = resolve_seed(body)
+    request_inputs = ()
+    if is_seeded_request(seed):
+        request_inputs = (model, prompt_digest(prompt), reasoning_effort, quack_thinking,
+                          max_tokens, quack_fill)
+        session = DuckSession()
+    rng = request_rng(seed, *request_inputs)
+
+    if endpoint == "/v1/chat/completions":
+        return generate_duck_response(model, prompt, reasoning_effort=reasoning_effort,
+                                      thinking=quack_thinking, session=session,
+                                      max_tokens=max_tokens, fill=quack_fill, rng=rng,
+                                      prompt_tokens=count_messages_tokens(messages))
+    generation = DuckGeneration(model, prompt, reasoning_effort, quack_thinking, session,
+                                max_tokens, quack_fill, rng)
+    return generate_text_completion(generation)
+
+class BatchStore:
+    """
+    Files and batches for the Batch API mock, kept in a local directory:
+    files/<id>.jsonl with files/<id>.json metadata, and batches/<id>.json.
+    Batches run on a bounded thread pool. Input is read line by line and output
+    lines are appended as they finish, so memory stays flat for any file size.
+    Batch objects are saved about once a second while running, so progress is
+    visible from every worker; cancellation works through a marker file.
+    """
+
+    SAVE_INTERVAL = 1.0
+
+    def __init__(self, root: str, workers: int = 2):
+        self.root = root
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        # Batches running in this process, kept live for retrieval
+        self._running: Dict[str, Dict[str, Any]] = {}
+
+    def _dir(self, kind: str) -> str:
+        path = os.path.join(self.root, kind)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _write_json(self, path: str, data: Dict[str, Any]) -> None:
+        # Write-then-rename so readers never see a partial object
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _read_json(path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    # Files
+
+    def file_path(self, file_id: str) -> str:
+        return os.path.join(self._dir("files"), f"{os.path.basename(file_id)}.jsonl")
+
+    def add_file(self, source, filename: str, purpose: str) -> Dict[str, Any]:
+        """Store an uploaded file, copying it in chunks"""
+        file_id = f"file-{secrets.token_hex(12)}"
+        with open(self.file_path(file_id), "wb") as f:
+            shutil.copyfileobj(source, f, 1024 * 1024)
+        return self._register_file(file_id, filename, purpose)
+
+    def _register_file(self, file_id: str, filename: str, purpose: str) -> Dict[str, Any]:
+        file_object = {
+            "id": file_id,
+            "object": "file",
+            "bytes": os.path.getsize(self.file_path(file_id)),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+        }
+        self._write_json(os.path.join(self._dir("files"), f"{file_id}.json"), file_object)
+        return file_object
+
+    def get_file(self, file_id: str) -> Optional[Dict[str, Any]]:
+        name = f"{os.path.basename(file_id)}.json"
+        return self._read_json(os.path.join(self._dir("files"), name))
+
+    # Batches
+
+    def _batch_path(self, batch_id: str) -> str:
+        return os.path.join(self._dir("batches"), f"{os.path.basename(batch_id)}.json")
+
+    def _cancel_path(self, batch_id: str) -> str:
+        return os.path.join(self._dir("batches"), f"{os.path.basename(batch_id)}.cancel")
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str = "24h",
+                     metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        now = int(time.time())
+        batch = {
+            "id": f"batch_{secrets.token_hex(12)}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": now,
+            "in_progress_at": None,
+            "expires_at": now + 24 * 3600,
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": metadata,
+        }
+        with self._lock:
+            self._running[batch["id"]] = batch
+        self._write_json(self._batch_path(batch["id"]), batch)
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix="qlm-batch")
+        self._executor.submit(self._run, batch)
+        return dict(batch)
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            batch = self._running.get(batch_id)
+            if batch is not None:
+                return {**batch, "request_counts": dict(batch["request_counts"])}
+        return self._read_json(self._batch_path(batch_id))
+
+    def list_batches(self, limit: int = 20, after: Optional[str] = None) -> Dict[str, Any]:
+        batches = []
+        for name in os.listdir(self._dir("batches")):
+            if name.endswith(".json"):
+                batch = self.get_batch(name[:-5])
+                if batch is not None:
+                    batches.append(batch)
+        batches.sort(key=lambda batch: (batch["created_at"], batch["id"]), reverse=True)
+        if after is not None:
+            ids = [batch["id"] for batch in batches]
+            batches = batches[ids.index(after) + 1:] if after in ids else []
+        page = batches[:limit]
+        return {
+            "object": "list",
+            "data": page,
+            "first_id": page[0]["id"] if page else None,
+            "last_id": page[-1]["id"] if page else None,
+            "has_more": len(batches) > limit,
+        }
+
+    def cancel_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        batch = self.get_batch(batch_id)
+        if batch is None:
+            return None
+        if batch["status"] in ("validating", "in_progress"):
+            open(self._cancel_path(batch_id), "w").close()
+            with self._lock:
+                running = self._running.get(batch_id)
+                target = running if running is not None else batch
+                target["status"] = "cancelling"
+                target["cancelling_at"] = int(time.time())
+            if running is None:
+                self._write_json(self._batch_path(batch_id), batch)
+            return self.get_batch(batch_id)
+        return batch
+
+    def _update(self, batch: Dict[str, Any], **fields: Any) -> None:
+        with self._lock:
+            batch.update(fields)
+            snapshot = {**batch, "request_counts": dict(batch["request_counts"])}
+        self._write_json(self._batch_path(batch["id"]), snapshot)
+
+    def _run(self, batch: Dict[str, Any]) -> None:
+        try:
+            self._process(batch)
+        except Exception as e:
+            LOG.error("batch_failed", batch=batch["id"])
+            self._update(batch, status="failed", failed_at=int(time.time()),
+                         errors={"object": "list",
+                                 "data": [{"code": "internal_error", "message": str(e)}]})
+        finally:
+            with self._lock:
+                self._running.pop(batch["id"], None)
+
+    def _process(self, batch: Dict[str, Any]) -> None:
+        input_path = self.file_path(batch["input_file_id"])
+        counts = batch["request_counts"]
+
+        # Validating: count request lines without loading the file
+        total = 0
+        with open(input_path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    total += 1
+        with self._lock:
+            counts["total"] = total
+        self._update(batch, status="in_progress", in_progress_at=int(time.time()))
+
+        output_id = f"file-{secrets.token_hex(12)}"
+        error_id = f"file-{secrets.token_hex(12)}"
+        session = DuckSession()
+        cancel_path = self._cancel_path(batch["id"])
+        cancelled = False
+        next_save = time.monotonic() + self.SAVE_INTERVAL
+
+        with open(input_path, "rb") as source, \
+                open(self.file_path(output_id), "w", encoding="utf-8") as output, \
+                open(self.file_path(error_id), "w", encoding="utf-8") as errors:
+            for line in source:
+                if not line.strip():
+                    continue
+                record, failed = self._process_line(line, batch["endpoint"], session)
+                (errors if failed else output).write(record + "\n")
+                with self._lock:
+                    counts["failed" if failed else "completed"] += 1
+
+                if time.monotonic() >= next_save:
+                    output.flush()
+                    errors.flush()
+                    if batch["status"] == "cancelling" or os.path.exists(cancel_path):
+                        cancelled = True
+                        break
+                    self._update(batch)
+                    next_save = time.monotonic() + self.SAVE_INTERVAL
+            cancelled = cancelled or batch["status"] == "cancelling" or os.path.exists(cancel_path)
+
+        self._update(batch, status="finalizing", finalizing_at=int(time.time()))
+        output_file = self._register_file(output_id, f"{batch['id']}_output.jsonl", "batch_output")
+        fields = {"output_file_id": output_file["id"]}
+        if counts["failed"]:
+            error_file = self._register_file(error_id, f"{batch['id']}_error.jsonl", "batch_output")
+            fields["error_file_id"] = error_file["id"]
+        else:
+            os.remove(self.file_path(error_id))
+        if cancelled:
+            fields.update(status="cancelled", cancelled_at=int(time.time()))
+        else:
+            fields.update(status="completed", completed_at=int(time.time()))
+        self._update(batch, **fields)
+        if os.path.exists(cancel_path):
+            os.remove(cancel_path)
+
+    @staticmethod
+    def _process_line(line: bytes, endpoint: str, session: DuckSession) -> tuple:
+        """(output or error JSONL record, failed) for one input line"""
+        custom_id = None
+        request_id = new_completion_id("batch_req")
+        try:
+            request = json.loads(line)
+            custom_id = request.get("custom_id")
+            if request.get("url", endpoint) != endpoint:
+                raise ValueError(f"url must be {endpoint} for this batch")
+            if request.get("method", "POST") != "POST":
+                raise ValueError("method must be POST")
+            body = request.get("body")
+            if not isinstance(body, dict):
+                raise ValueError("body must be a JSON object")
+            response_body = batch_request_response(endpoint, body, session)
+        except HTTPException as e:
+            error = {"code": "invalid_request", "message": str(e.detail)}
+        except (ValueError, AttributeError, TypeError) as e:
+            error = {"code": "invalid_request", "message": str(e)}
+        except Exception as e:
+            # One bad line is written to the error file; the rest of the batch still runs
+            LOG.error("batch_request_failed", custom_id=custom_id, error=str(e))
+            error = {"code": "internal_error", "message": f"{type(e).__name__}: {e}"}
+        else:
+            return json.dumps({
+                "id": request_id,
+                "custom_id": custom_id,
+                "response": {"status_code": 200, "request_id": request_id, "body": response_body},
+                "error": None,
+            }), False
+        line = {"id": request_id, "custom_id": custom_id, "response": None, "error": error}
+        return json.dumps(line), True
+
+BATCHES = BatchStore(
+    os.environ.get("QLM_BATCH_DIR", os.path.join(tempfile.gettempdir(), "qlm-batches")),
+    int(os.environ.get("QLM_BATCH_WORKERS", "2")),
+)
+
 @app.get("/")
 async def root():
     """Root endpoint - serve interactive chat demo"""
@@ -434,6 +3239,11 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "timestamp": int(time.time())}
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics endpoint"""
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/models")
 async def list_models():
     """List available models (OpenAI API compatibility)"""
@@ -444,13 +3254,15 @@ async def list_models():
                 "id": "quack-model",
                 "object": "model",
                 "created": int(time.time()),
-                "owned_by": "quack-lang-model"
+                "owned_by": "quack-lang-model",
+                "latency_profile": MODEL_LATENCY_PROFILES.get("quack-model", "classic")
             },
             {
                 "id": "reasoning-duck",
                 "object": "model",
                 "created": int(time.time()),
-                "owned_by": "quack-lang-model"
+                "owned_by": "quack-lang-model",
+                "latency_profile": MODEL_LATENCY_PROFILES.get("reasoning-duck", "classic")
             }
         ]
     }
@@ -465,15 +3277,23 @@ async def chat_completions(
     Supports reasoning_effort parameter for OpenAI-compatible reasoning.
     Requires API key authentication (keys starting with 'sk-v1-42').
     """
+    model = "unknown"
     try:
-        # Parse request body
-        body = await request.json()
+        # Decode only what is used: top-level fields, and messages on demand
+        try:
+            body = LazyChatRequest(await read_body(request))
+            last_message = body.message(-1)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON body: {e}")
         
-        # Log request for debugging
-        print(f"=== INCOMING REQUEST ===")
-        print(f"Model: {body.get('model', 'unknown')}")
-        print(f"Stream: {body.get('stream', False)}")
-        print(f"Authorization: {authorization[:20]}..." if authorization else "None")
+        # Log request (sampled, written off the event loop)
+        LOG.request(
+            "chat_request",
+            path=request.url.path,
+            model=body.get("model", "unknown"),
+            stream=body.get("stream", False),
+            authorization=authorization
+        )
         
         # Validate API key
         if not validate_api_key(authorization):
@@ -484,112 +3304,118 @@ async def chat_completions(
 
         # Extract request parameters
         model = body.get("model", "quack-model")
-        messages = body.get("messages", [])
-        max_tokens = body.get("max_tokens", 100)
+        max_tokens = resolve_max_tokens(body)
         reasoning_effort = body.get("reasoning_effort", None)
         quack_thinking = body.get("quack_thinking", False)
+        quack_fill = body.get("quack_fill", False)
 
-        # Get the last user message as prompt
-        prompt = ""
-        if messages:
-            last_message = messages[-1]
-            if last_message.get("role") == "user":
-                content = last_message.get("content", "")
-                
-                # Handle multimodal content (Roo sends content as list)
-                if isinstance(content, list):
-                    # Extract text from multimodal content
-                    text_parts = []
-                    for part in content:
-                        if isinstance(part, dict) and part.get("type") == "text":
-                            text_parts.append(part.get("text", ""))
-                    prompt = " ".join(text_parts)
-                else:
-                    prompt = content
+        # Get the last user message as prompt; usage counts the whole conversation
+        prompt = message_prompt(last_message)
+        blocks = MESSAGE_TOKENS.message_tokens(body)
+        prompt_tokens = REPLY_PRIMING_TOKENS + sum(count for _, count in blocks)
+
+        # Repeat avoidance is tracked per API key and conversation
+        conversation = body.get("user") or body.conversation_bytes()
+        session = SESSIONS.get(session_key(authorization, conversation))
+
+        # Seeded requests get a generator derived from the seed and every input that shapes
+        # the output, and no repeat history, so identical requests give identical content
+        seed = resolve_seed(body)
+        seeded = is_seeded_request(seed)
+        request_inputs = ()
+        if seeded:
+            request_inputs = (model, prompt_digest(prompt), reasoning_effort, quack_thinking,
+                              max_tokens, quack_fill)
+            session = DuckSession()
+        rng = request_rng(seed, *request_inputs)
+
+        # Simulated provider timing (header overrides the model's profile)
+        latency = resolve_latency_profile(model, request.headers.get("x-qlm-latency-profile"))
+        latency_random = latency_rng(seed)
 
         # Check if streaming is requested
         stream = body.get("stream", False)
-        
         if stream:
-            # Return streaming response
-            async def generate_stream():
-                # Generate the duck response
-                response_data = generate_duck_response(model, prompt, reasoning_effort=reasoning_effort, thinking=quack_thinking)
-                content = response_data["choices"][0]["message"]["content"]
-                
-                # Stream the response in chunks (character by character for effect)
-                chunk_id = f"chatcmpl-{secrets.token_hex(16)}"
-                
-                # Send initial chunk
-                yield f"data: {json.dumps({'id': chunk_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model, 'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}]})}\n\n"
-                
-                # Stream content
-                for char in content:
-                    chunk = {
-                        "id": chunk_id,
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": model,
-                        "choices": [{
-                            "index": 0,
-                            "delta": {"content": char},
-                            "finish_reason": None
-                        }]
-                    }
-                    yield f"data: {json.dumps(chunk)}\n\n"
-                    await asyncio.sleep(0.01)  # Small delay for streaming effect
-                
-                # Send final chunk with usage info (if requested)
-                final_chunk = {
-                    "id": chunk_id,
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": model,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {},
-                        "finish_reason": "stop"
-                    }]
-                }
-                
-                # Include usage if stream_options.include_usage is true
-                if body.get("stream_options", {}).get("include_usage", False):
-                    final_chunk["usage"] = response_data["usage"]
-                
-                yield f"data: {json.dumps(final_chunk)}\n\n"
-                yield "data: [DONE]\n\n"
-            
-            return StreamingResponse(
-                generate_stream(),
-                media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                }
+            resolve_stream_options(body.get("stream_options"))
+
+        # Per-key limits, charged once the request is known to be valid: the prompt and
+        # any max_tokens reservation count up front
+        reserved_tokens = prompt_tokens + (max_tokens or 0)
+        rate_limit_headers = enforce_rate_limit(authorization, reserved_tokens)
+
+        # Simulated prompt caching: the longest prefix this key sent recently
+        cached_tokens = PREFIX_CACHE.cached_tokens(api_key_of(authorization), blocks)
+        if cached_tokens and PREFIX_CACHE_TTFT_DISCOUNT:
+            discount = PREFIX_CACHE_TTFT_DISCOUNT * cached_tokens / prompt_tokens
+            latency = latency.with_ttft_scale(1.0 - discount)
+
+        if stream:
+            # Shared streaming engine; the stream slot is taken once the request is valid
+            generation = DuckGeneration(model, prompt, reasoning_effort, quack_thinking, session,
+                                        max_tokens, quack_fill, rng, prompt_tokens, cached_tokens)
+            response = streaming_response(
+                generation, SSEFrameEncoder(new_completion_id(), model), latency, latency_random,
+                body.get("stream_options"),
+                on_usage=functools.partial(account_usage, authorization, max_tokens),
+                headers=rate_limit_headers
             )
+            await admit_stream(request, authorization, reserved_tokens)
+            return response
         else:
+            # Seeded requests are replayed from the serialized response cache
+            # The cached body carries usage, so the key also covers the conversation's size,
+            # and the catalog version so replies from before a catalog reload are not replayed
+            cache_key = None
+            if seeded:
+                cache_key = derive_seed(seed, "chat.completion", *request_inputs, prompt_tokens,
+                                        cached_tokens, CATALOG.version)
+            cached = RESPONSE_CACHE.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                body_bytes, usage = cached
+                account_usage(authorization, max_tokens, usage)
+                tokens = usage["completion_tokens"]
+                delay = latency.generation_time_for_tokens(tokens, latency_random)
+                await STREAM_SCHEDULER.sleep(delay)
+                return Response(content=replay_body(body_bytes), media_type="application/json",
+                                headers=rate_limit_headers)
+
             # Non-streaming response
-            response = generate_duck_response(model, prompt, reasoning_effort=reasoning_effort, thinking=quack_thinking)
-            return JSONResponse(content=response)
+            response = generate_duck_response(model, prompt, reasoning_effort=reasoning_effort,
+                                              thinking=quack_thinking, session=session,
+                                              max_tokens=max_tokens, fill=quack_fill, rng=rng,
+                                              prompt_tokens=prompt_tokens,
+                                              cached_tokens=cached_tokens)
+            account_usage(authorization, max_tokens, response["usage"])
+            tokens = response["usage"]["completion_tokens"]
+            json_response = JSONResponse(content=response, headers=rate_limit_headers)
+            if cache_key is not None:
+                RESPONSE_CACHE.put(cache_key, json_response.body, response["usage"])
+
+            await STREAM_SCHEDULER.sleep(latency.generation_time_for_tokens(tokens, latency_random))
+            return json_response
 
     except HTTPException:
         raise
     except Exception as e:
         # Log the error for debugging
-        import traceback
-        print(f"ERROR in chat_completions: {str(e)}")
-        print(f"Model: {body.get('model', 'unknown') if 'body' in locals() else 'unknown'}")
-        traceback.print_exc()
+        LOG.error(
+            "chat_completions_failed",
+            error=str(e),
+            model=model
+        )
         raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
 
 @app.post("/completions")
 async def completions(
     request: Dict[str, Any],
-    authorization: str = Header(None)
+    authorization: str = Header(None),
+    x_qlm_latency_profile: str = Header(None),
+    http_request: Request = None
 ):
     """
     Legacy completions endpoint for backwards compatibility.
     Supports reasoning_effort parameter for OpenAI-compatible reasoning.
+    Streams text_completion chunks when stream is true.
     Requires API key authentication (keys starting with 'sk-v1-42').
     """
     try:
@@ -601,55 +3427,104 @@ async def completions(
             )
 
         model = request.get("model", "quack-model")
-        prompt = request.get("prompt", "")
-        max_tokens = request.get("max_tokens", 100)
+        prompt = resolve_prompt(request)
+        max_tokens = resolve_max_tokens(request)
         reasoning_effort = request.get("reasoning_effort", None)
         quack_thinking = request.get("quack_thinking", False)
+        quack_fill = request.get("quack_fill", False)
+        prompt_tokens = count_tokens(prompt)
+        session = SESSIONS.get(session_key(authorization, request.get("user")))
+        latency = resolve_latency_profile(model, x_qlm_latency_profile)
+        stream = request.get("stream", False)
+        if stream:
+            resolve_stream_options(request.get("stream_options"))
 
-        # Check for enhanced responses first
-        enhanced_response = check_enhanced_responses(prompt)
-        if enhanced_response:
-            response_content = enhanced_response
-        else:
-            # Normal duck sound generation
-            response_content = select_duck_sound()
+        # Seeded requests get their own generator and no repeat history
+        seed = resolve_seed(request)
 
-        # Add reasoning if requested or if model is reasoning-capable
-        if reasoning_effort or "reasoning" in model.lower():
-            reasoning_content = select_duck_reasoning(reasoning_effort or "medium")
-            response_content = f"{reasoning_content}\n\n{response_content}"
+        # Per-key limits, charged once the request is known to be valid
+        reserved_tokens = prompt_tokens + (max_tokens or 0)
+        rate_limit_headers = enforce_rate_limit(authorization, reserved_tokens)
 
-        # Add thinking message if legacy thinking parameter is used
-        if quack_thinking:
-            thinking_message = select_duck_thinking()
-            response_content = f"{thinking_message}\n\n{response_content}"
+        request_inputs = ()
+        if is_seeded_request(seed):
+            request_inputs = (model, prompt_digest(prompt), reasoning_effort, quack_thinking,
+                              max_tokens, quack_fill)
+            session = DuckSession()
+        rng = request_rng(seed, *request_inputs)
 
-        response = {
-            "id": f"cmpl-{secrets.token_hex(16)}",
-            "object": "text_completion",
-            "created": int(time.time()),
-            "model": model,
-            "choices": [
-                {
-                    "text": response_content,
-                    "index": 0,
-                    "finish_reason": "stop"
-                }
-            ],
-            "usage": {
-                "prompt_tokens": len(prompt.split()) if prompt else 0,
-                "completion_tokens": len(response_content.split()),
-                "total_tokens": (len(prompt.split()) if prompt else 0) + len(response_content.split())
-            }
-        }
+        # Same generation engine as chat (enhanced responses, reasoning, thinking, max_tokens, fill)
+        generation = DuckGeneration(model, prompt, reasoning_effort, quack_thinking, session,
+                                    max_tokens, quack_fill, rng, prompt_tokens)
+
+        if stream:
+            response = streaming_response(
+                generation, TextCompletionFrameEncoder(new_completion_id("cmpl"), model), latency,
+                latency_rng(seed), request.get("stream_options"),
+                on_usage=functools.partial(account_usage, authorization, max_tokens),
+                headers=rate_limit_headers
+            )
+            if http_request is not None:
+                await admit_stream(http_request, authorization, reserved_tokens)
+            return response
 
-        return JSONResponse(content=response)
+        response = generate_text_completion(generation)
+        account_usage(authorization, max_tokens, response["usage"])
+        text = response["choices"][0]["text"]
+        await STREAM_SCHEDULER.sleep(latency.generation_time(text, latency_rng(seed)))
+        return JSONResponse(content=response, headers=rate_limit_headers)
 
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating completion: {str(e)}")
 
+@app.post("/embeddings")
+async def embeddings(
+    request: Dict[str, Any],
+    authorization: str = Header(None)
+):
+    """
+    Embeddings endpoint: deterministic duck vectors derived from input hashes.
+    Supports dimensions and encoding_format ("float" or "base64").
+    Requires API key authentication (keys starting with 'sk-v1-42').
+    """
+    if not validate_api_key(authorization):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid API key. Please use a key starting with 'sk-v1-42'"
+        )
+
+    texts = embedding_inputs(request.get("input"))
+    dimensions = request.get("dimensions")
+    if dimensions is None:
+        dimensions = EMBEDDING_DIMENSIONS
+    if isinstance(dimensions, bool) or not isinstance(dimensions, int) \
+            or not 1 <= dimensions <= EMBEDDING_MAX_DIMENSIONS:
+        raise HTTPException(status_code=400,
+                            detail=f"dimensions must be between 1 and {EMBEDDING_MAX_DIMENSIONS}")
+    encoding_format = request.get("encoding_format") or "float"
+    if encoding_format not in ("float", "base64"):
+        raise HTTPException(status_code=400, detail="encoding_format must be 'float' or 'base64'")
+
+    prompt_tokens = sum(count_tokens(text) for text in texts)
+    rate_limit_headers = enforce_rate_limit(authorization, prompt_tokens)
+    USAGE_TOKENS.labels("prompt").inc(prompt_tokens)
+
+    usage = {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}
+
+    def encode() -> bytes:
+        vectors = embed_texts(texts, dimensions)
+        model = request.get("model", EMBEDDING_MODEL)
+        return build_embedding_body(vectors, encoding_format, model, usage)
+
+    # Large requests are computed and serialized off the event loop
+    if len(texts) * dimensions > EMBEDDING_INLINE_VALUES:
+        body = await asyncio.to_thread(encode)
+    else:
+        body = encode()
+    return Response(content=body, media_type="application/json", headers=rate_limit_headers)
+
 # Additional OpenAI-compatible endpoints
 @app.get("/v1/models")
 async def list_models_v1(authorization: str = Header(None)):
@@ -671,13 +3546,181 @@ async def chat_completions_v1(
 @app.post("/v1/completions")
 async def completions_v1(
     request: Dict[str, Any],
-    authorization: str = Header(None)
+    authorization: str = Header(None),
+    x_qlm_latency_profile: str = Header(None),
+    http_request: Request = None
 ):
     """OpenAI v1 completions endpoint"""
     if not validate_api_key(authorization):
         raise HTTPException(status_code=401, detail="Invalid API key")
-    return await completions(request, authorization)
+    return await completions(request, authorization, x_qlm_latency_profile, http_request)
 
-if __name__ == "__main__":
+@app.post("/v1/embeddings")
+async def embeddings_v1(request: Dict[str, Any], authorization: str = Header(None)):
+    """OpenAI v1 embeddings endpoint"""
+    if not validate_api_key(authorization):
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    return await embeddings(request, authorization)
+
+# Files and batches
+
+def require_api_key(authorization: Optional[str]) -> None:
+    if not validate_api_key(authorization):
+        raise HTTPException(status_code=401, detail="Invalid API key")
+
+@app.post("/v1/files")
+async def upload_file(
+    file: UploadFile = File(...),
+    purpose: str = Form("batch"),
+    authorization: str = Header(None)
+):
+    """Upload a JSONL file (e.g. batch input)"""
+    require_api_key(authorization)
+    filename = file.filename or "upload.jsonl"
+    return await asyncio.to_thread(BATCHES.add_file, file.file, filename, purpose)
+
+@app.get("/v1/files/{file_id}")
+async def retrieve_file(file_id: str, authorization: str = Header(None)):
+    """File metadata"""
+    require_api_key(authorization)
+    file_object = BATCHES.get_file(file_id)
+    if file_object is None:
+        raise HTTPException(status_code=404, detail=f"No such file: {file_id}")
+    return file_object
+
+@app.get("/v1/files/{file_id}/content")
+async def file_content(file_id: str, authorization: str = Header(None)):
+    """File contents, streamed from disk"""
+    require_api_key(authorization)
+    if BATCHES.get_file(file_id) is None:
+        raise HTTPException(status_code=404, detail=f"No such file: {file_id}")
+    return FileResponse(BATCHES.file_path(file_id), media_type="application/jsonl")
+
+@app.post("/v1/batches")
+async def create_batch(request: Dict[str, Any], authorization: str = Header(None)):
+    """Create a batch over an uploaded JSONL file of requests"""
+    require_api_key(authorization)
+    endpoint = request.get("endpoint")
+    if endpoint not in BATCH_ENDPOINTS:
+        raise HTTPException(status_code=400,
+                            detail=f"endpoint must be one of: {', '.join(BATCH_ENDPOINTS)}")
+    input_file_id = request.get("input_file_id")
+    if not input_file_id or BATCHES.get_file(input_file_id) is None:
+        raise HTTPException(status_code=400, detail=f"No such input file: {input_file_id}")
+    return BATCHES.create_batch(input_file_id, endpoint, request.get("completion_window", "24h"),
+                                request.get("metadata"))
+
+@app.get("/v1/batches")
+async def list_batches(limit: int = 20, after: Optional[str] = None,
+                       authorization: str = Header(None)):
+    """List batches, newest first"""
+    require_api_key(authorization)
+    return BATCHES.list_batches(max(1, min(limit, 100)), after)
+
+@app.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str, authorization: str = Header(None)):
+    """Batch status with live request counts"""
+    require_api_key(authorization)
+    batch = BATCHES.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"No such batch: {batch_id}")
+    return batch
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, authorization: str = Header(None)):
+    """Cancel a batch; lines already processed stay in its output file"""
+    require_api_key(authorization)
+    batch = BATCHES.cancel_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"No such batch: {batch_id}")
+    return batch
+
+# Multi-worker serving
+
+def _run_worker(sock: socket.socket, index: int, log_level: str) -> None:
+    """Worker process body: serve the inherited socket until told to stop"""
+    import uvicorn
+
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    METRICS.use_stripe(index)
+    config = uvicorn.Config(app, log_level=log_level)
+    uvicorn.Server(config).run(sockets=[sock])
+
+def serve(host: str = "0.0.0.0", port: int = 8000, workers: int = 1,
+          log_level: str = "info") -> None:
+    """
+    Serve the API with N pre-forked workers sharing one listening socket.
+    Metrics and usage totals live in shared memory, so /metrics on any worker reports
+    the whole server. Workers that die are restarted; SIGINT/SIGTERM stops them all.
+    """
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+    if workers <= 1 or not hasattr(os, "fork"):
+        uvicorn.run(app, host=host, port=port, log_level=log_level)
+        return
+
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    # Shared state must exist before fork so every worker maps the same pages
+    METRICS.share(workers)
+    if RATE_LIMITER.enabled:
+        RATE_LIMITER.share()
+
+    def spawn(index: int) -> int:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(sock, index, log_level)
+            except BaseException:
+                LOG.error("worker_failed", worker=index)
+                code = 1
+            finally:
+                LOG.stop()
+                os._exit(code)
+        return pid
+
+    children = {spawn(index): index for index in range(workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    LOG.warning("workers_started", workers=workers, host=host, port=port)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            LOG.warning("worker_restarted", worker=index, status=status)
+            children[spawn(index)] = index
+
+    sock.close()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the QLM API")
+    parser.add_argument("--host", default=os.environ.get("QLM_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("QLM_WORKERS", "1")),
+                        help="Worker processes (0 = one per CPU core)")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers or os.cpu_count() or 1, args.log_level)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the QLM generation and serialization hot paths.
+
+Measures ops/sec and per-call allocations (tracemalloc) for duck selection,
+token counting, enhanced response checks, response generation and SSE chunk encoding.
+Runs offline: the API module is imported directly, no server is started.
+
+Usage:
+    python benchmarks/bench_hotpaths.py                      # save results/<commit>.json
+    python benchmarks/bench_hotpaths.py --compare results/abc1234.json
+    python benchmarks/bench_hotpaths.py -k sse --min-time 1
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from api import main as qlm  # noqa: E402
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+# Prompt text that does not trigger the deterministic enhanced response
+PROMPT_TEXT = "Please review this function and explain why the duck keeps quacking at the pond. "
+
+def make_prompt(size: int) -> str:
+    """Prompt of roughly size bytes"""
+    return (PROMPT_TEXT * (size // len(PROMPT_TEXT) + 1))[:size]
+
+def encode_sse_stream(loop: asyncio.AbstractEventLoop, model: str, chunking: str, max_tokens: int) -> int:
+    """Run the shared streaming engine without pacing and return the bytes produced"""
+    generation = qlm.DuckGeneration(model, "Quack?", max_tokens=max_tokens, fill=True)
+    encoder = qlm.SSEFrameEncoder(qlm.new_completion_id(), model)
+    frames = qlm.stream_generation(generation, encoder, qlm.LATENCY_PROFILES["instant"], None,
+                                   chunking, qlm.STREAM_CHUNK_SIZE, 0, include_usage=True)
+
+    async def consume() -> int:
+        total = 0
+        async for frame in frames:
+            total += len(frame)
+        return total
+
+    return loop.run_until_complete(consume())
+
+def build_benchmarks() -> List[Tuple[str, Callable[[], object]]]:
+    """(name, zero-argument callable) pairs; setup cost stays outside the callables"""
+    session = qlm.DuckSession()
+    loop = asyncio.new_event_loop()
+    small_prompt = make_prompt(64)
+    medium_prompt = make_prompt(4096)
+    large_prompt = make_prompt(4 * 1024 * 1024)
+
+    return [
+        ("select_duck_sound", lambda: qlm.select_duck_sound(session)),
+        ("select_duck_thinking", lambda: qlm.select_duck_thinking(session)),
+        ("select_duck_reasoning[low]", lambda: qlm.select_duck_reasoning("low")),
+        ("select_duck_reasoning[medium]", lambda: qlm.select_duck_reasoning("medium")),
+        ("select_duck_reasoning[high]", lambda: qlm.select_duck_reasoning("high")),
+        ("count_tokens[4KB]", lambda: qlm.count_tokens(medium_prompt)),
+        ("check_enhanced_responses[64B]", lambda: qlm.check_enhanced_responses(small_prompt)),
+        ("check_enhanced_responses[4MB]", lambda: qlm.check_enhanced_responses(large_prompt)),
+        ("generate_duck_response[quack-model]",
+         lambda: qlm.generate_duck_response("quack-model", small_prompt, session=session)),
+        ("generate_duck_response[quack-model,thinking]",
+         lambda: qlm.generate_duck_response("quack-model", small_prompt, thinking=True, session=session)),
+        ("generate_duck_response[reasoning-duck]",
+         lambda: qlm.generate_duck_response("reasoning-duck", small_prompt, reasoning_effort="high",
+                                            session=session)),
+        ("generate_duck_response[quack-model,fill=1000]",
+         lambda: qlm.generate_duck_response("quack-model", small_prompt, session=session,
+                                            max_tokens=1000, fill=True)),
+        ("sse_encode[char,1000 tokens]", lambda: encode_sse_stream(loop, "quack-model", "char", 1000)),
+        ("sse_encode[token,1000 tokens]", lambda: encode_sse_stream(loop, "quack-model", "token", 1000)),
+        ("sse_encode[word,1000 tokens]", lambda: encode_sse_stream(loop, "quack-model", "word", 1000)),
+    ]
+
+def measure_speed(func: Callable[[], object], min_time: float, repeats: int) -> Dict[str, float]:
+    """Best-of-repeats ops/sec, each repeat running long enough to cover min_time"""
+    # Calibrate the loop count so one repeat takes about min_time
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10 or loops >= 1 << 24:
+            break
+        loops *= 2
+    loops = max(1, int(loops * (min_time / max(elapsed, 1e-9)) / repeats))
+
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        best = min(best, (time.perf_counter() - start) / loops)
+    return {"ops_per_sec": 1.0 / best, "mean_us": best * 1e6, "loops": loops}
+
+def measure_allocations(func: Callable[[], object], calls: int) -> Dict[str, float]:
+    """Peak traced bytes of a single call, and bytes still held after `calls` calls (per call)"""
+    func()  # warm caches (lazy alias tables, regex compilation) before tracing
+    gc.collect()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        peak_bytes = peak - before
+
+        start, _ = tracemalloc.get_traced_memory()
+        for _ in range(calls):
+            func()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"peak_bytes": peak_bytes, "retained_bytes_per_call": max(0, current - start) / calls}
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(filters: List[str], min_time: float, repeats: int, alloc_calls: int) -> Dict[str, object]:
+    results = {}
+    for name, func in build_benchmarks():
+        if filters and not any(f in name for f in filters):
+            continue
+        result = measure_speed(func, min_time, repeats)
+        result.update(measure_allocations(func, alloc_calls))
+        results[name] = result
+        print(f"{name:48} {result['ops_per_sec']:>14,.0f} ops/s {result['peak_bytes']:>12,} B peak")
+    return {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "rng_backend": qlm.RNG_BACKEND,
+        "min_time": min_time,
+        "repeats": repeats,
+        "benchmarks": results,
+    }
+
+def compare(baseline: Dict[str, object], current: Dict[str, object]) -> None:
+    """Print ops/sec and peak allocation changes against a saved run"""
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}:")
+    print(f"{'benchmark':48} {'ops/s':>10} {'peak bytes':>12}")
+    for name, result in current["benchmarks"].items():
+        old = baseline["benchmarks"].get(name)
+        if old is None:
+            print(f"{name:48} {'new':>10}")
+            continue
+        speed = result["ops_per_sec"] / old["ops_per_sec"]
+        memory = (result["peak_bytes"] / old["peak_bytes"]) if old["peak_bytes"] else float("nan")
+        print(f"{name:48} {speed:>9.2f}x {memory:>11.2f}x")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="QLM hot path micro-benchmarks")
+    parser.add_argument("-k", dest="filters", action="append", default=[],
+                        help="Only run benchmarks whose name contains this text (repeatable)")
+    parser.add_argument("--min-time", type=float, default=0.5, help="Seconds of timing per benchmark")
+    parser.add_argument("--repeats", type=int, default=5, help="Timing repeats (best one is kept)")
+    parser.add_argument("--alloc-calls", type=int, default=20, help="Calls traced for retained memory")
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    current = run(args.filters, args.min_time, args.repeats, args.alloc_calls)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{current['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(current, f, indent=2)
+    print(f"\nSaved results to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), current)
+
+if __name__ == "__main__":
+    main()
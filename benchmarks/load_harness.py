@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+End-to-end load harness for a local QLM server.
+
+Runs N concurrent async clients that mix streaming and non-streaming requests
+across quack-model and reasoning-duck, then reports latency percentiles,
+time to first token, inter-chunk gaps, tokens/sec and error rates.
+
+Usage:
+    python benchmarks/load_harness.py --spawn -c 64 -n 5000
+    python benchmarks/load_harness.py --url http://localhost:8000 -c 200 --duration 30 \\
+        --stream-ratio 0.8 --reasoning-ratio 0.25 --latency-profile instant
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class RequestResult:
+    """Timing of one request, in seconds since it was sent"""
+
+    __slots__ = ("model", "stream", "status", "error", "latency", "ttft", "gaps", "tokens", "disconnected")
+
+    def __init__(self, model: str, stream: bool):
+        self.model = model
+        self.stream = stream
+        self.status = None
+        self.error = None
+        self.latency = None
+        self.ttft = None
+        self.gaps = []
+        self.tokens = 0
+        self.disconnected = False
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None or self.status != 200
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed and not self.disconnected
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+def build_payload(args: argparse.Namespace, model: str, stream: bool, rng: random.Random) -> Dict[str, Any]:
+    payload = {
+        "model": model,
+        "messages": [{"role": "user", "content": f"Load test message {rng.randrange(1_000_000)}"}],
+        "stream": stream,
+    }
+    if model == "reasoning-duck":
+        payload["reasoning_effort"] = rng.choice(("low", "medium", "high"))
+    if args.max_tokens is not None:
+        payload["max_tokens"] = args.max_tokens
+    if args.fill:
+        payload["quack_fill"] = True
+    if stream:
+        stream_options = {"include_usage": True}
+        if args.tokens_per_second is not None:
+            stream_options["tokens_per_second"] = args.tokens_per_second
+        payload["stream_options"] = stream_options
+    return payload
+
+async def send_request(client: httpx.AsyncClient, payload: Dict[str, Any],
+                       disconnect: bool = False) -> RequestResult:
+    """Send one request; with disconnect, a stream is abandoned after its first content chunk"""
+    result = RequestResult(payload["model"], payload["stream"])
+    start = time.perf_counter()
+    try:
+        if not payload["stream"]:
+            response = await client.post("/chat/completions", json=payload)
+            result.status = response.status_code
+            result.latency = result.ttft = time.perf_counter() - start
+            if response.status_code == 200:
+                result.tokens = response.json()["usage"]["completion_tokens"]
+            return result
+
+        async with client.stream("POST", "/chat/completions", json=payload) as response:
+            result.status = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+                result.latency = time.perf_counter() - start
+                return result
+
+            last_chunk = None
+            async for line in response.aiter_lines():
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                chunk = json.loads(line[6:])
+                if chunk.get("usage"):
+                    result.tokens = chunk["usage"]["completion_tokens"]
+                choices = chunk.get("choices") or [{}]
+                if not choices[0].get("delta", {}).get("content"):
+                    continue
+                now = time.perf_counter()
+                if last_chunk is None:
+                    result.ttft = now - start
+                else:
+                    result.gaps.append(now - last_chunk)
+                last_chunk = now
+                if disconnect:
+                    # Leaving the stream context closes the connection mid-stream
+                    result.disconnected = True
+                    break
+        result.latency = time.perf_counter() - start
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        result.error = type(e).__name__
+        result.latency = time.perf_counter() - start
+    return result
+
+async def worker(client: httpx.AsyncClient, args: argparse.Namespace, rng: random.Random,
+                 budget: Dict[str, int], deadline: Optional[float], results: List[RequestResult]) -> None:
+    while True:
+        if deadline is not None:
+            if time.perf_counter() >= deadline:
+                return
+        elif budget["remaining"] <= 0:
+            return
+        budget["remaining"] -= 1
+
+        model = "reasoning-duck" if rng.random() < args.reasoning_ratio else "quack-model"
+        stream = rng.random() < args.stream_ratio
+        disconnect = stream and rng.random() < args.disconnect_ratio
+        results.append(await send_request(client, build_payload(args, model, stream, rng), disconnect))
+
+async def run_load(args: argparse.Namespace, url: str) -> Dict[str, Any]:
+    headers = {"Authorization": f"Bearer {args.api_key}"}
+    if args.latency_profile:
+        headers["x-qlm-latency-profile"] = args.latency_profile
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    timeout = httpx.Timeout(args.timeout)
+
+    results: List[RequestResult] = []
+    budget = {"remaining": args.requests}
+    async with httpx.AsyncClient(base_url=url, headers=headers, limits=limits, timeout=timeout) as client:
+        # Warm up connections so the first measured requests don't pay for connection setup
+        await asyncio.gather(*(client.get("/health") for _ in range(args.concurrency)),
+                             return_exceptions=True)
+        start = time.perf_counter()
+        deadline = start + args.duration if args.duration else None
+        await asyncio.gather(*(
+            worker(client, args, random.Random(args.seed + index), budget, deadline, results)
+            for index in range(args.concurrency)
+        ))
+        wall_time = time.perf_counter() - start
+
+    return build_report(args, results, wall_time)
+
+def build_report(args: argparse.Namespace, results: List[RequestResult], wall_time: float) -> Dict[str, Any]:
+    ok = [r for r in results if r.ok]
+    streams = [r for r in ok if r.stream]
+    failed = [r for r in results if r.failed]
+    errors = Counter(r.error or str(r.status) for r in failed)
+    total_tokens = sum(r.tokens for r in ok)
+
+    # Per-stream generation rate, after the first token arrives
+    stream_rates = [r.tokens / (r.latency - r.ttft) for r in streams
+                    if r.ttft is not None and r.latency > r.ttft and r.tokens]
+
+    by_kind = {}
+    for r in results:
+        by_kind.setdefault(f"{r.model}/{'stream' if r.stream else 'json'}", []).append(r)
+
+    return {
+        "config": {
+            "concurrency": args.concurrency,
+            "requests": args.requests if not args.duration else None,
+            "duration": args.duration,
+            "stream_ratio": args.stream_ratio,
+            "reasoning_ratio": args.reasoning_ratio,
+            "max_tokens": args.max_tokens,
+            "fill": args.fill,
+            "latency_profile": args.latency_profile,
+            "tokens_per_second": args.tokens_per_second,
+            "disconnect_ratio": args.disconnect_ratio,
+        },
+        "wall_time": wall_time,
+        "requests": len(results),
+        "requests_per_sec": len(results) / wall_time if wall_time else None,
+        "error_rate": len(failed) / len(results) if results else None,
+        "disconnected": sum(1 for r in results if r.disconnected),
+        "errors": dict(errors),
+        "latency": summarize([r.latency for r in ok]),
+        "ttft": summarize([r.ttft for r in results if r.stream and not r.failed and r.ttft is not None]),
+        "inter_chunk_gap": summarize([gap for r in streams for gap in r.gaps]),
+        "tokens_per_sec": {
+            "aggregate": total_tokens / wall_time if wall_time else None,
+            "per_stream": summarize(stream_rates),
+        },
+        "by_kind": {
+            kind: {
+                "requests": len(items),
+                "errors": sum(1 for r in items if r.failed),
+                "latency": summarize([r.latency for r in items if r.ok]),
+            }
+            for kind, items in sorted(by_kind.items())
+        },
+    }
+
+def format_ms(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.1f}ms"
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"Requests: {report['requests']} in {report['wall_time']:.2f}s "
+          f"({report['requests_per_sec']:.1f} req/s), error rate {report['error_rate']:.2%}")
+    if report["errors"]:
+        print(f"Errors: {report['errors']}")
+    if report["disconnected"]:
+        print(f"Streams abandoned mid-stream: {report['disconnected']}")
+    print(f"{'':16} {'p50':>10} {'p95':>10} {'p99':>10} {'max':>10}")
+    for label, key in (("latency", "latency"), ("ttft", "ttft"), ("inter-chunk gap", "inter_chunk_gap")):
+        stats = report[key]
+        print(f"{label:16} " + " ".join(f"{format_ms(stats[q]):>10}" for q in ("p50", "p95", "p99", "max")))
+    rates = report["tokens_per_sec"]
+    per_stream = rates["per_stream"]["p50"]
+    print(f"Tokens/sec: {rates['aggregate']:.1f} aggregate, "
+          f"{'-' if per_stream is None else f'{per_stream:.1f}'} per stream (p50)")
+    for kind, stats in report["by_kind"].items():
+        print(f"  {kind:28} {stats['requests']:>7} requests {stats['errors']:>5} errors "
+              f"p50 {format_ms(stats['latency']['p50'])}")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def wait_for_server(url: str, process: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient(base_url=url) as client:
+        while time.perf_counter() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"QLM server exited with code {process.returncode}")
+            try:
+                if (await client.get("/health")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError("QLM server did not become healthy in time")
+
+async def main_async(args: argparse.Namespace) -> Dict[str, Any]:
+    if not args.spawn:
+        return await run_load(args, args.url)
+
+    # Start a local server with request logging sampled down so it doesn't skew results
+    port = free_port()
+    env = {"QLM_LOG_SAMPLE_RATE": "1000", **os.environ}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=ROOT, env=env
+    )
+    try:
+        url = f"http://127.0.0.1:{port}"
+        await wait_for_server(url, process)
+        return await run_load(args, url)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="QLM end-to-end load harness")
+    parser.add_argument("--url", default="http://localhost:8000", help="QLM server to load")
+    parser.add_argument("--spawn", action="store_true", help="Start a local QLM server on a free port")
+    parser.add_argument("-c", "--concurrency", type=int, default=32, help="Concurrent clients")
+    parser.add_argument("-n", "--requests", type=int, default=1000, help="Total requests (ignored with --duration)")
+    parser.add_argument("--duration", type=float, help="Run for this many seconds instead of a request count")
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="Fraction of streaming requests")
+    parser.add_argument("--reasoning-ratio", type=float, default=0.5, help="Fraction sent to reasoning-duck")
+    parser.add_argument("--max-tokens", type=int, help="max_tokens for every request")
+    parser.add_argument("--fill", action="store_true", help="Request long-form output (quack_fill)")
+    parser.add_argument("--latency-profile", help="x-qlm-latency-profile header, e.g. instant or standard")
+    parser.add_argument("--tokens-per-second", type=float, help="stream_options.tokens_per_second")
+    parser.add_argument("--disconnect-ratio", type=float, default=0.0,
+                        help="Fraction of streams the client abandons after the first chunk")
+    parser.add_argument("--api-key", default="sk-v1-42test", help="API key (must start with sk-v1-42)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the request mix")
+    parser.add_argument("--output", help="Write the full report as JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved report to {args.output}")
+
+if __name__ == "__main__":
+    main()